@@ -1,10 +1,14 @@
 # app.py
-from flask import Flask, jsonify, send_from_directory
+from flask import Flask, jsonify, send_from_directory, request
 from flask_socketio import SocketIO
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo.errors import ConnectionFailure
 from bson import ObjectId
+from bson.errors import InvalidId
 from dotenv import load_dotenv
+import base64
 import os
+import email_stats
 import threading
 import time
 
@@ -17,64 +21,142 @@ socketio = SocketIO(app, cors_allowed_origins="*")
 MONGO_URI = os.getenv("MONGO_URI")
 if not MONGO_URI:
     raise ValueError("MONGO_URI missing in .env")
+MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "email_agent_db")
 client = MongoClient(MONGO_URI)
-db = client["email_agent_db"]
+db = client[MONGO_DB_NAME]
 logs = db["email_logs"]
-print("Connected to MongoDB: email_agent_db.email_logs")
-
-last_count = 0
-def watch_mongo():
-    global last_count
-    print("Polling watcher started (every 2 sec)...")
-    while True:
-        try:
-            cur = logs.count_documents({})
-            if cur > last_count:
-                print(f"New email detected! {last_count} → {cur}")
-                socketio.emit('new_email')
-                last_count = cur
-            time.sleep(2)
-        except Exception as e:
-            print("Polling error:", e)
-            time.sleep(5)
-
-threading.Thread(target=watch_mongo, daemon=True).start()
+stats = db["email_stats"]
+print(f"Connected to MongoDB: {MONGO_DB_NAME}.email_logs")
 
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# The list view only needs headers and the snippet; full bodies come from /api/emails/<id>.
+# Sorting relies on the (processed_at, _id) index that gmail_ai_agent.ensure_indexes() creates.
+LIST_PROJECTION = {"body": 0, "ai_reply.body": 0, "triage_headers": 0}
+# Used only until the agent has built the email_stats counters.
+STATS_CACHE_SECONDS = 10
+_stats_cache = {"value": None, "at": 0.0}
+# Fallback tailing re-reads this many seconds behind the newest processed_at it has seen,
+# because concurrent agent workers can commit slightly out of order.
+TAIL_INTERVAL = 2
+TAIL_OVERLAP = 10
+watcher_state = {"mode": None}
 
 @app.route("/")
 def index():
     return send_from_directory(app.static_folder, "dashboard.html")
 
+def encode_cursor(doc):
+    raw = f"{doc.get('processed_at', 0)}:{doc['_id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor):
+    processed_at, _, oid = base64.urlsafe_b64decode(cursor.encode()).decode().partition(":")
+    return int(processed_at), ObjectId(oid)
+
+def serialize(doc):
+    doc["_id"] = str(doc["_id"])
+    doc.setdefault("ai_category", "other")
+    if doc["ai_category"] is None:
+        doc["ai_category"] = "other"
+    return doc
+
+def summarize(doc):
+    # The same fields as a list entry, so clients can patch their view in place.
+    doc = {k: v for k, v in doc.items() if k not in LIST_PROJECTION}
+    if isinstance(doc.get("ai_reply"), dict):
+        doc["ai_reply"] = {k: v for k, v in doc["ai_reply"].items() if k != "body"}
+    return serialize(doc)
+
+def conditional_json(payload):
+    # Weak validators are enough here: an unchanged page answers 304 with no body.
+    resp = jsonify(payload)
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.add_etag()
+    return resp.make_conditional(request)
+
 @app.route("/api/emails")
 def get_emails():
-    emails = list(logs.find().sort("processed_at", -1))
-    for e in emails:
-        e["_id"] = str(e["_id"])
-        e.setdefault("ai_category", "other")
-    return jsonify(emails)
+    # Keyset pagination on (processed_at, _id), newest first. `cursor` is the next_cursor
+    # of the previous page; `account` limits the list to one mailbox.
+    try:
+        limit = min(max(int(request.args.get("limit", PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        query = {}
+        if request.args.get("account"):
+            query["account"] = request.args["account"]
+        if request.args.get("cursor"):
+            processed_at, oid = decode_cursor(request.args["cursor"])
+            query["$or"] = [
+                {"processed_at": {"$lt": processed_at}},
+                {"processed_at": processed_at, "_id": {"$lt": oid}}
+            ]
+    except (ValueError, InvalidId) as e:
+        return jsonify({"success": False, "error": f"Bad pagination parameters: {e}"}), 400
+
+    docs = list(
+        logs.find(query, LIST_PROJECTION)
+        .sort([("processed_at", DESCENDING), ("_id", DESCENDING)])
+        .limit(limit + 1)
+    )
+    next_cursor = encode_cursor(docs[limit - 1]) if len(docs) > limit else None
+    return conditional_json({"emails": [serialize(d) for d in docs[:limit]], "next_cursor": next_cursor})
+
+@app.route("/api/emails/<email_id>")
+def get_email(email_id):
+    try:
+        doc = logs.find_one({"_id": ObjectId(email_id)})
+    except InvalidId as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    if not doc:
+        return jsonify({"success": False, "error": "Not found"}), 404
+    return conditional_json(serialize(doc))
 
 @app.route("/api/stats")
 def api_stats():
-    total = logs.count_documents({})
-    cats = {
-        "interview": logs.count_documents({"ai_category": "interview"}),
-        "meeting":   logs.count_documents({"ai_category": "meeting"}),
-        "important_email": logs.count_documents({"ai_category": "important_email"}),
-        "not_important":   logs.count_documents({"ai_category": "not_important"}),
-        "other":           logs.count_documents({"ai_category": "other"})
-    }
-    return jsonify({"total": total, "categories": cats})
+    totals = email_stats.read_totals(stats)
+    if totals is None:
+        if time.time() - _stats_cache["at"] > STATS_CACHE_SECONDS:
+            _stats_cache.update(value=email_stats.aggregate_totals(logs), at=time.time())
+        totals = _stats_cache["value"]
+    return jsonify(totals)
+
+@app.route("/api/stats/trend")
+def api_stats_trend():
+    # Per-hour or per-day counts for trend charts, oldest first.
+    kind = request.args.get("bucket", "hour")
+    if kind not in email_stats.BUCKETS:
+        return jsonify({"success": False, "error": f"bucket must be one of {list(email_stats.BUCKETS)}"}), 400
+    try:
+        limit = min(max(int(request.args.get("limit", 48)), 1), 1000)
+    except ValueError:
+        return jsonify({"success": False, "error": "limit must be an integer"}), 400
+    docs = list(stats.find({"kind": kind}).sort("bucket_start", DESCENDING).limit(limit))
+    return jsonify([
+        {
+            "bucket_start": d["bucket_start"],
+            "total": d.get("total", 0),
+            "categories": {c: d.get("categories", {}).get(c, 0) for c in email_stats.CATEGORIES}
+        }
+        for d in reversed(docs)
+    ])
 
 @app.route("/api/delete/<email_id>", methods=["DELETE"])
 def delete_email(email_id):
     try:
-        res = logs.delete_one({"_id": ObjectId(email_id)})
+        doc = logs.find_one_and_delete({"_id": ObjectId(email_id)}, projection={"ai_category": 1, "processed_at": 1})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 400
 
-    if res.deleted_count:
+    if doc:
+        # Counters only exist once the agent has seeded them; decrementing before that would
+        # upsert negative totals that hide the aggregation fallback for good.
+        if email_stats.read_totals(stats) is None:
+            _stats_cache["at"] = 0.0
+        elif doc.get("processed_at") is not None:
+            stats.bulk_write(email_stats.stats_updates(doc.get("ai_category"), doc["processed_at"], -1))
         print(f"Deleted email ID: {email_id}")
-        socketio.emit('refresh')
+        if watcher_state["mode"] != "change_stream":
+            socketio.emit('email_deleted', {"_id": email_id})
         return jsonify({"success": True})
     return jsonify({"success": False, "error": "Not found"}), 404
 
@@ -84,6 +166,67 @@ def manual_refresh():
     socketio.emit('refresh')
     return jsonify({"success": True})
 
+def watch_change_stream():
+    # Pushes inserts, updates and deletes as they happen. Returns False right away when the
+    # server has no change streams (standalone mongod), so the caller can fall back to tailing.
+    resume_token = None
+    pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+    while True:
+        try:
+            with logs.watch(pipeline, full_document="updateLookup", resume_after=resume_token) as stream:
+                if watcher_state["mode"] is None:
+                    watcher_state["mode"] = "change_stream"
+                    print("Change stream watcher started.")
+                for change in stream:
+                    resume_token = stream.resume_token
+                    op = change["operationType"]
+                    if op == "delete":
+                        socketio.emit('email_deleted', {"_id": str(change["documentKey"]["_id"])})
+                    elif change.get("fullDocument"):
+                        event = 'new_email' if op == "insert" else 'email_updated'
+                        socketio.emit(event, summarize(change["fullDocument"]))
+        except ConnectionFailure as e:
+            print("Change stream error:", e)
+            time.sleep(5)
+        except Exception as e:
+            # e.g. OperationFailure 40573 on a standalone server
+            if watcher_state["mode"] is None:
+                print(f"Change streams unavailable ({e}).")
+                return False
+            print("Change stream error:", e)
+            resume_token = None
+            time.sleep(5)
+
+def tail_email_logs():
+    # Keyset tailing on (processed_at, _id): each poll is an indexed range read of recent entries.
+    # Deletes made through this app are announced by delete_email itself.
+    watcher_state["mode"] = "tailing"
+    print(f"Tailing email_logs every {TAIL_INTERVAL}s...")
+    newest = logs.find_one({}, {"processed_at": 1}, sort=[("processed_at", DESCENDING), ("_id", DESCENDING)])
+    last_ts = newest["processed_at"] if newest else 0
+    # Entries already inside the overlap window at startup are not news.
+    seen = {d["_id"]: d["processed_at"] for d in logs.find({"processed_at": {"$gte": last_ts - TAIL_OVERLAP}}, {"processed_at": 1})}
+    while True:
+        try:
+            cursor = logs.find({"processed_at": {"$gte": last_ts - TAIL_OVERLAP}}, LIST_PROJECTION) \
+                .sort([("processed_at", ASCENDING), ("_id", ASCENDING)])
+            for doc in cursor:
+                if doc["_id"] not in seen:
+                    seen[doc["_id"]] = doc["processed_at"]
+                    socketio.emit('new_email', serialize(doc))
+                last_ts = max(last_ts, doc["processed_at"])
+            seen = {k: v for k, v in seen.items() if v >= last_ts - TAIL_OVERLAP}
+            time.sleep(TAIL_INTERVAL)
+        except Exception as e:
+            print("Tailing error:", e)
+            time.sleep(5)
+
+def watch_mongo():
+    if watch_change_stream() is False:
+        tail_email_logs()
+
+threading.Thread(target=watch_mongo, daemon=True).start()
+
 if __name__ == "__main__":
     print("AI Email Dashboard → http://127.0.0.1:5000")
     socketio.run(app, host="127.0.0.1", port=5000, debug=False)
\ No newline at end of file
@@ -0,0 +1,796 @@
+# benchmark.py
+# Benchmarks for the Gmail AI agent that run without Google services.
+#
+#   python benchmark.py persistence --messages 2000 --batch-size 20
+#   python benchmark.py pipeline --messages 500 --gemini-latency 0.3 --mongo mongomock
+#   python benchmark.py parse --messages 2000
+#   python benchmark.py gemini --calls 50 --gemini-latency 0.2
+#   python benchmark.py app --documents 100000 --pages 20
+#
+# Gmail, Calendar and Gemini are replaced by in-process fakes with configurable latency.
+# Mongo is MONGO_URI (a local mongod is fine) or, with --mongo mongomock, an in-memory
+# stand-in (pip install mongomock). Either way the scratch database MONGO_DB_NAME
+# (default email_agent_bench) is dropped before and after the run.
+# Every benchmark prints its result as JSON; --output also saves it so runs can be compared.
+import argparse
+import base64
+import json
+import os
+import platform
+import re
+import threading
+import time
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+os.environ.setdefault("MONGO_DB_NAME", "email_agent_bench")
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+import gmail_ai_agent as agent
+import email_stats
+
+
+def fake_record(i: int) -> dict:
+    return {
+        "id": f"bench-{i:08d}",
+        "thread_id": f"thread-{i:08d}",
+        "snippet": "Quarterly planning sync",
+        "subject": f"Planning sync #{i}",
+        "from": "Planner <planner@example.com>",
+        "from_email": "planner@example.com",
+        "to": "me@example.com",
+        "date": "Mon, 1 Sep 2025 10:00:00 +0530",
+        "message_id_header": f"<bench-{i}@example.com>",
+        "triage_headers": {},
+        "body": "Can we meet on Thursday to go over the roadmap? " * 20
+    }
+
+STRUCTURED = {
+    "category": "meeting",
+    "confidence": 0.9,
+    "action": "reply",
+    "classified_by": "gemini",
+    "reply_template": {"should_reply": True, "subject": "Re: Planning sync", "body": "Thursday works."}
+}
+
+
+def b64(text: str, encoding: str = "utf-8") -> str:
+    return base64.urlsafe_b64encode(text.encode(encoding)).decode()
+
+def text_part(mime_type: str, text: str, charset: str = "utf-8") -> dict:
+    return {
+        "mimeType": mime_type,
+        "headers": [{"name": "Content-Type", "value": f'{mime_type}; charset="{charset}"'}],
+        "body": {"size": len(text), "data": b64(text, charset)}
+    }
+
+def synthetic_message(i: int, user_email: str = "me@example.com") -> dict:
+    # A Gmail API `full` message. Four shapes in rotation: an interview invite with a PDF,
+    # an HTML-only newsletter, a quoted reply in latin-1 and a meeting mail with an inline image.
+    kind = i % 4
+    headers = [
+        {"name": "To", "value": user_email},
+        {"name": "Date", "value": "Mon, 1 Sep 2025 10:00:00 +0530"},
+        {"name": "Message-ID", "value": f"<synthetic-{i}@example.com>"}
+    ]
+    if kind == 0:
+        subject, sender = f"Interview invitation for the backend role #{i}", f"Recruiter {i % 7} <talent{i % 7}@acme.example>"
+        plain = (f"Hi,\n\nWe would like to invite you to a technical interview on 2025-09-{10 + i % 18:02d} at 10:00 IST.\n"
+                 "The call takes an hour. Please confirm the slot.\n\nBest,\nAcme Talent\n")
+        payload = {"mimeType": "multipart/mixed", "parts": [
+            {"mimeType": "multipart/alternative", "parts": [
+                text_part("text/plain", plain),
+                text_part("text/html", "<html><body><p>" + plain.replace("\n", "<br>") + "</p></body></html>")
+            ]},
+            {"mimeType": "application/pdf", "filename": "job-description.pdf",
+             "body": {"size": 48213, "attachmentId": f"att-{i}"}}
+        ]}
+    elif kind == 1:
+        subject, sender = f"Weekly digest #{i}: ten things you missed", "Digest <newsletter@news.example>"
+        headers += [{"name": "List-Unsubscribe", "value": "<mailto:unsubscribe@news.example>"},
+                    {"name": "Precedence", "value": "bulk"}]
+        items = "".join(f"<tr><td><a href='https://news.example/item/{i}/{n}'>Story {n}</a> "
+                        f"Short teaser text for story {n} of this week.</td></tr>" for n in range(10))
+        html = ("<html><head><style>td{font-family:sans-serif}</style><script>track()</script></head>"
+                f"<body><table>{items}</table><p>Unsubscribe at any time.</p></body></html>")
+        payload = text_part("text/html", html)
+    elif kind == 2:
+        subject, sender = f"Re: Contract renewal {i}", "José Núñez <jose@partner.example>"
+        quoted = "\n".join("> " + line for line in ["Could you send the signed copy?"] * 30)
+        plain = (f"Hello,\n\nThe signed contract is attached to the portal, reference {i}.\n\nRegards,\nJosé\n\n"
+                 f"On Mon, 1 Sep 2025 at 09:00, Me <{user_email}> wrote:\n{quoted}\n")
+        payload = text_part("text/plain", plain, charset="iso-8859-1")
+    else:
+        subject, sender = f"Meeting: roadmap review {i}", f"Planner <planner{i % 5}@example.com>"
+        plain = f"Team,\n\nRoadmap review on 2025-09-{10 + i % 18:02d} 15:00 IST in room 4.\n\n-- \nPlanner\n"
+        payload = {"mimeType": "multipart/related", "parts": [
+            {"mimeType": "multipart/alternative", "parts": [
+                text_part("text/plain", plain),
+                text_part("text/html", f"<div>{plain}</div><img src='cid:logo'>")
+            ]},
+            {"mimeType": "image/png", "filename": "logo.png", "body": {"size": 5120, "attachmentId": f"img-{i}"}}
+        ]}
+    # For single-part mail the part's own Content-Type sits among the message headers.
+    headers = [{"name": "Subject", "value": subject}, {"name": "From", "value": sender}] + headers
+    payload = dict(payload, headers=headers + payload.get("headers", []))
+    return {
+        "id": f"{i:016x}",
+        "threadId": f"t{i:015x}",
+        "labelIds": ["UNREAD", "IMPORTANT", "INBOX"],
+        "snippet": subject[:100],
+        "sizeEstimate": len(json.dumps(payload)),
+        "payload": payload
+    }
+
+
+def parse_fields(spec: str) -> dict:
+    # A Google API field mask ("id,payload(headers,body/data)") as a tree; None selects the whole subtree.
+    tree, depth, token = {}, 0, ""
+    for ch in spec + ",":
+        if ch == "," and depth == 0:
+            name, _, rest = token.strip().partition("/")
+            if "(" in name:
+                name, _, inner = token.strip().partition("(")
+                sub = parse_fields(inner[:-1])
+            else:
+                sub = parse_fields(rest) if rest else None
+            if name:
+                tree[name] = sub
+            token = ""
+            continue
+        depth += (ch == "(") - (ch == ")")
+        token += ch
+    return tree
+
+def apply_fields(value, tree):
+    # Keeps only what a field mask selects, as the API does, so a missing field shows up in tests.
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [apply_fields(v, tree) for v in value]
+    if not isinstance(value, dict):
+        return value
+    return {k: apply_fields(value[k], sub) for k, sub in tree.items() if k in value}
+
+
+class FakeRequest:
+    def __init__(self, fn, latency: float = 0.0):
+        self.fn = fn
+        self.latency = latency
+
+    def execute(self, http=None, num_retries=0):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.fn()
+
+class FakeBatch:
+    # One round trip of latency for the whole batch, like a real multipart batch request.
+    def __init__(self, callback, latency: float):
+        self.callback = callback
+        self.latency = latency
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request, callback or self.callback, request_id or str(len(self.requests))))
+
+    def execute(self, http=None):
+        if self.latency:
+            time.sleep(self.latency)
+        for request, callback, request_id in self.requests:
+            try:
+                callback(request_id, request.fn(), None)
+            except Exception as e:
+                callback(request_id, None, e)
+
+class FakeGmail:
+    """In-memory Gmail API covering the calls the agent makes, with a fixed delay per request.
+
+    `fields` masks are applied to responses, so a mask that drops something the agent reads
+    loses it here too. The initial messages predate history id 1000; deliver() and add_labels()
+    record history after that, and expire_history() makes older start ids answer 404.
+    """
+
+    def __init__(self, messages: int, latency: float = 0.0, user_email: str = "me@example.com"):
+        self.user_email = user_email
+        self.latency = latency
+        self.messages_by_id = {}
+        self.order = []
+        for i in range(messages):
+            self._store(synthetic_message(i, user_email))
+        self.history_records = []
+        self.history_id = 1000
+        self.oldest_history_id = 1000
+        self.history_page_size = 100
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def _store(self, msg: dict):
+        self.messages_by_id[msg["id"]] = msg
+        self.order = sorted(self.messages_by_id)
+
+    def _record(self, kind: str, msg: dict, **extra):
+        self.history_id += 1
+        entry = dict(extra, message={"id": msg["id"], "threadId": msg["threadId"], "labelIds": list(msg["labelIds"])})
+        self.history_records.append({"id": str(self.history_id), kind: [entry]})
+
+    def deliver(self, i: int, label_ids: list = None) -> dict:
+        msg = synthetic_message(i, self.user_email)
+        if label_ids is not None:
+            msg["labelIds"] = list(label_ids)
+        self._store(msg)
+        self._record("messagesAdded", msg)
+        return msg
+
+    def add_labels(self, msg_id: str, label_ids: list):
+        msg = self.messages_by_id[msg_id]
+        msg["labelIds"] += [label for label in label_ids if label not in msg["labelIds"]]
+        self._record("labelsAdded", msg, labelIds=list(label_ids))
+
+    def expire_history(self):
+        self.oldest_history_id = self.history_id
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return self
+
+    def getProfile(self, userId):
+        return FakeRequest(lambda: {"emailAddress": self.user_email, "historyId": str(self.history_id)}, self.latency)
+
+    def list(self, userId, q=None, maxResults=100, pageToken=None, startHistoryId=None, historyTypes=None, **kwargs):
+        if startHistoryId is not None:
+            return FakeRequest(lambda: self._history_page(int(startHistoryId), historyTypes, pageToken), self.latency)
+        if q and q.startswith("rfc822msgid:"):
+            wanted = q.split(":", 1)[1]
+            return FakeRequest(lambda: {"messages": [m for m in self.sent if m["message_id"] == wanted]}, self.latency)
+        start = int(pageToken or 0)
+        def page():
+            ids = self.order[start:start + maxResults]
+            resp = {"messages": [{"id": i, "threadId": self.messages_by_id[i]["threadId"]} for i in ids],
+                    "resultSizeEstimate": len(self.order)}
+            if start + maxResults < len(self.order):
+                resp["nextPageToken"] = str(start + maxResults)
+            return resp
+        return FakeRequest(page, self.latency)
+
+    def _history_page(self, start: int, history_types: list, page_token: str) -> dict:
+        if start < self.oldest_history_id:
+            raise HttpError(httplib2.Response({"status": 404}), b"Requested entity was not found.")
+        # historyTypes takes the enum names ("messageAdded"); records use the plural keys.
+        kinds = [kind.replace("message", "messages").replace("label", "labels")
+                 for kind in history_types or ["messageAdded", "labelAdded"]]
+        records = [r for r in self.history_records if int(r["id"]) > start and any(k in r for k in kinds)]
+        offset = int(page_token or 0)
+        resp = {"history": records[offset:offset + self.history_page_size], "historyId": str(self.history_id)}
+        if offset + self.history_page_size < len(records):
+            resp["nextPageToken"] = str(offset + self.history_page_size)
+        return resp
+
+    def get(self, userId, id, format="full", metadataHeaders=None, fields=None):
+        def fetch():
+            msg = json.loads(json.dumps(self.messages_by_id[id]))
+            if format == "metadata":
+                wanted = {h.lower() for h in metadataHeaders or []}
+                msg["payload"] = {"headers": [h for h in msg["payload"]["headers"] if h["name"].lower() in wanted]}
+            return apply_fields(msg, parse_fields(fields)) if fields else msg
+        return FakeRequest(fetch, self.latency)
+
+    def batchModify(self, userId, body):
+        def modify():
+            with self.lock:
+                for msg_id in body["ids"]:
+                    labels = self.messages_by_id[msg_id]["labelIds"]
+                    for label in body.get("removeLabelIds", []):
+                        if label in labels:
+                            labels.remove(label)
+            return ""
+        return FakeRequest(modify, self.latency)
+
+    def send(self, userId, body):
+        def send():
+            raw = base64.urlsafe_b64decode(body["raw"]).decode("utf-8", "replace")
+            match = re.search(r"^Message-ID: (.+)$", raw, re.M)
+            with self.lock:
+                self.sent.append({"id": f"sent-{len(self.sent)}", "message_id": match.group(1).strip() if match else None})
+                return self.sent[-1]
+        return FakeRequest(send, self.latency)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(callback, self.latency)
+
+class FakeCalendar:
+    """In-memory Calendar events. Like the real API, a deleted event keeps its id reserved:
+    it stays as status "cancelled" and inserting the id again answers 409."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.events_by_id = {}
+        self.lock = threading.Lock()
+
+    def events(self):
+        return self
+
+    def insert(self, calendarId, body):
+        def insert():
+            with self.lock:
+                if body.get("id") in self.events_by_id:
+                    raise HttpError(httplib2.Response({"status": 409}), b"The requested identifier already exists.")
+                event = dict(body, status="confirmed", htmlLink=f"https://calendar.example/{body.get('id')}")
+                self.events_by_id[body.get("id")] = event
+                return event
+        return FakeRequest(insert, self.latency)
+
+    def patch(self, calendarId, eventId, body):
+        def patch():
+            with self.lock:
+                if eventId not in self.events_by_id:
+                    raise HttpError(httplib2.Response({"status": 404}), b"Not Found")
+                self.events_by_id[eventId].update(body)
+                return dict(self.events_by_id[eventId])
+        return FakeRequest(patch, self.latency)
+
+    def delete(self, calendarId, eventId):
+        def delete():
+            with self.lock:
+                self.events_by_id[eventId]["status"] = "cancelled"
+            return ""
+        return FakeRequest(delete, self.latency)
+
+    def visible(self) -> list:
+        return [e for e in self.events_by_id.values() if e.get("status") != "cancelled"]
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(callback, self.latency)
+
+class FakeUsage:
+    def __init__(self, prompt_tokens: int, output_tokens: int):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+
+class FakeResponse:
+    def __init__(self, text: str, prompt: str):
+        self.text = text
+        self.usage_metadata = FakeUsage(len(prompt) // agent.CHARS_PER_TOKEN, len(text) // agent.CHARS_PER_TOKEN)
+
+class FakeGemini:
+    """Stands in for the GenerativeModel: canned JSON picked from the subject, after `latency` seconds."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    @staticmethod
+    def classify(text: str) -> dict:
+        subject = text.partition("Email Subject:")[2].strip().split("\n", 1)[0].lower()
+        event = {"summary": None, "start": None, "end": None, "location": None, "description": None}
+        if "interview" in subject or "meeting" in subject:
+            category = "interview" if "interview" in subject else "meeting"
+            event = {"summary": subject, "start": "2025-09-18T10:00:00+05:30", "end": "2025-09-18T11:00:00+05:30",
+                     "location": "Online", "description": None}
+            reply = {"should_reply": True, "subject": f"Re: {subject}", "body": "Thank you, the slot works for me."}
+            action = "reply"
+        elif "digest" in subject:
+            category, action = "not_important", "archive"
+            reply = {"should_reply": False, "subject": None, "body": None}
+        else:
+            category, action = "important_email", "no_action"
+            reply = {"should_reply": False, "subject": None, "body": None}
+        return {"category": category, "confidence": 0.95, "summary": subject, "action": action,
+                "reply_template": reply, "metadata": {"calendar_event": event}}
+
+    def generate_content(self, contents):
+        prompt = contents[0]["parts"][0]
+        if self.latency:
+            time.sleep(self.latency)
+        chunks = prompt.split("### Email id: ")[1:]
+        if chunks:
+            answer = [dict(self.classify(chunk), id=chunk.split("\n", 1)[0].strip()) for chunk in chunks]
+        else:
+            answer = self.classify(prompt)
+        return FakeResponse(json.dumps(answer), prompt)
+
+
+def percentile(samples: list, pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))]
+
+def latency_summary(samples: list) -> dict:
+    return {
+        "calls": len(samples),
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "total_s": round(sum(samples), 3)
+    }
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None
+
+class StageTimer:
+    """Times every call to the given agent functions by swapping in wrappers on the module.
+
+    The pipeline looks these names up as module globals at call time, so the wrappers see
+    calls from every worker thread. restore() puts the originals back.
+    """
+
+    STAGES = {
+        "sync": "sync_new_messages",
+        "claim": "claim_messages",
+        "fetch_metadata": "get_messages_batch",
+        "triage": "triage_messages",
+        "fetch_bodies": "fetch_bodies",
+        "classify": "classify_messages",
+        "plan_actions": "plan_actions",
+        "persist": "persist_results",
+        "outbox": "execute_actions"
+    }
+
+    def __init__(self):
+        self.samples = {stage: [] for stage in self.STAGES}
+        self.originals = {}
+        self.lock = threading.Lock()
+
+    def install(self):
+        for stage, name in self.STAGES.items():
+            original = getattr(agent, name)
+            self.originals[name] = original
+            setattr(agent, name, self.wrap(stage, original))
+
+    def wrap(self, stage, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    self.samples[stage].append(elapsed)
+        return timed
+
+    def restore(self):
+        for name, original in self.originals.items():
+            setattr(agent, name, original)
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {stage: latency_summary(samples) for stage, samples in self.samples.items()}
+
+
+def use_mongo(backend: str):
+    # "uri" keeps MONGO_URI; "mongomock" swaps an in-memory client into the agent's lazy client slot.
+    if agent.MONGO_DB_NAME == "email_agent_db":
+        raise ValueError("Refusing to benchmark against the live email_agent_db database")
+    if backend == "mongomock":
+        try:
+            import mongomock
+        except ImportError:
+            raise SystemExit("--mongo mongomock needs the mongomock package (pip install mongomock)")
+        patch_mongomock(mongomock)
+        agent.close_client()
+        agent._clients["mongo"] = mongomock.MongoClient()
+    agent.get_client().drop_database(agent.MONGO_DB_NAME)
+
+def patch_mongomock(mongomock):
+    # mongomock 4.x predates the `sort` argument pymongo 4.9+ passes to bulk updates, and it is
+    # not thread-safe, while the agent writes from several pipeline threads. Serialize its calls.
+    builder = mongomock.collection.BulkOperationBuilder
+    if getattr(builder, "_bench_patched", False):
+        return
+    add_update = builder.add_update
+    def add_update_without_sort(self, *args, **kwargs):
+        kwargs.pop("sort", None)
+        return add_update(self, *args, **kwargs)
+    builder.add_update = add_update_without_sort
+    builder._bench_patched = True
+
+    # mongomock also writes "_id" into the projection dict it is given, which corrupts shared
+    # module-level projections such as app.LIST_PROJECTION.
+    find = mongomock.collection.Collection.find
+    def find_with_copied_projection(self, filter=None, projection=None, *args, **kwargs):
+        return find(self, filter, dict(projection) if isinstance(projection, dict) else projection, *args, **kwargs)
+    mongomock.collection.Collection.find = find_with_copied_projection
+
+    lock = threading.RLock()
+    collection = mongomock.collection.Collection
+    for name in ("insert_one", "insert_many", "update_one", "update_many", "delete_one", "delete_many",
+                 "find_one", "find_one_and_update", "find_one_and_delete", "bulk_write", "count_documents",
+                 "create_index", "aggregate"):
+        method = getattr(collection, name)
+        def locked(self, *args, _method=method, **kwargs):
+            with lock:
+                return _method(self, *args, **kwargs)
+        setattr(collection, name, locked)
+
+
+def bench_persistence(messages: int, batch_size: int, mongo: str = "uri") -> dict:
+    use_mongo(mongo)
+    try:
+        agent.ensure_indexes()
+        records = [fake_record(i) for i in range(messages)]
+        half = messages // 2
+
+        # Per-message path: find_one + insert_one + insert_one for every message.
+        start = time.perf_counter()
+        for data in records[:half]:
+            if not agent.is_processed(data["id"]):
+                agent.store_email_and_reply(data, STRUCTURED["reply_template"], "Sent automated reply.", STRUCTURED)
+                agent.mark_processed(data["id"])
+        per_message = (time.perf_counter() - start) / max(1, half)
+
+        # Batched path: one $in lookup and one bulk write per collection for each cycle.
+        start = time.perf_counter()
+        rest = records[half:]
+        for i in range(0, len(rest), batch_size):
+            chunk = rest[i:i + batch_size]
+            done = agent.processed_ids([data["id"] for data in chunk])
+            agent.persist_results([
+                (data, STRUCTURED["reply_template"], "Sent automated reply.", STRUCTURED)
+                for data in chunk if data["id"] not in done
+            ])
+        batched = (time.perf_counter() - start) / max(1, len(rest))
+
+        return {
+            "benchmark": "persistence",
+            "messages": messages,
+            "batch_size": batch_size,
+            "per_message_ms": round(per_message * 1000, 3),
+            "batched_ms": round(batched * 1000, 3),
+            "speedup": round(per_message / batched, 2) if batched else None
+        }
+    finally:
+        agent.get_client().drop_database(agent.MONGO_DB_NAME)
+
+def bench_pipeline(messages: int, gemini_latency: float, gmail_latency: float, classify_workers: int,
+                   act_workers: int, batch_size: int, gemini_rpm: float, mongo: str = "uri",
+                   timeout: float = 600) -> dict:
+    # Drives the production loop pieces (poll_account, MessagePipeline, OutboxDrainer) against
+    # a synthetic mailbox until every message is processed and its outbox actions have run.
+    use_mongo(mongo)
+    gmail = FakeGmail(messages, latency=gmail_latency)
+    calendar = FakeCalendar(latency=gmail_latency)
+    saved = (agent.build_gmail_service, agent.build_calendar_service, agent._clients["gemini"], agent.gemini_limiter)
+    agent.build_gmail_service = lambda creds: gmail
+    agent.build_calendar_service = lambda creds: calendar
+    agent._clients["gemini"] = FakeGemini(gemini_latency)
+    agent.gemini_limiter = agent.TokenBucket(gemini_rpm / 60.0, max(1, classify_workers))
+    timer = StageTimer()
+    timer.install()
+    pipeline = drainer = None
+    try:
+        agent.ensure_indexes()
+        agent.ensure_stats()
+        account = agent.Account(gmail.user_email, creds=object())
+        pipeline = agent.MessagePipeline(classify_workers=classify_workers, act_workers=act_workers,
+                                         classify_batch_size=batch_size)
+        pipeline.start()
+        drainer = agent.OutboxDrainer({account.user_email: account})
+        drainer.start()
+        finished = {"status": {"$in": ["done", "failed"]}}
+        unfinished_actions = {"status": {"$in": ["pending", "in_progress"]}}
+
+        rss_before = peak_rss_kb()
+        start = time.perf_counter()
+        while time.perf_counter() - start < timeout:
+            if not agent.poll_account(pipeline, account):
+                pipeline.join()
+                if (agent.processed_collection.count_documents(finished) >= messages
+                        and not agent.outbox_collection.count_documents(unfinished_actions)):
+                    break
+                time.sleep(0.05)
+        elapsed = time.perf_counter() - start
+
+        stats = agent.get_stats()
+        processed = agent.processed_collection.count_documents(finished)
+        return {
+            "benchmark": "pipeline",
+            "messages": messages,
+            "processed": processed,
+            "timed_out": processed < messages,
+            "elapsed_s": round(elapsed, 3),
+            "emails_per_second": round(processed / elapsed, 2) if elapsed else None,
+            "gemini_latency_s": gemini_latency,
+            "gmail_latency_s": gmail_latency,
+            "classify_workers": classify_workers,
+            "act_workers": act_workers,
+            "gemini_batch_size": batch_size,
+            "stages": timer.summary(),
+            "memory": {"peak_rss_kb_before": rss_before, "peak_rss_kb": peak_rss_kb()},
+            "replies_sent": len(gmail.sent),
+            "calendar_events": len(calendar.events_by_id),
+            "counters": {k: v for k, v in stats.items() if k.startswith(("gemini_", "cache_", "preclassify_", "outbox_"))}
+        }
+    finally:
+        if pipeline is not None:
+            pipeline.stop()
+        if drainer is not None:
+            drainer.stop()
+        timer.restore()
+        agent.build_gmail_service, agent.build_calendar_service, agent._clients["gemini"], agent.gemini_limiter = saved
+        agent.get_client().drop_database(agent.MONGO_DB_NAME)
+
+def bench_parse(messages: int) -> dict:
+    # get_message_snippet_and_body over the synthetic MIME shapes: fetch plus body extraction.
+    gmail = FakeGmail(messages)
+    samples = []
+    body_chars = 0
+    for msg_id in gmail.order:
+        start = time.perf_counter()
+        data = agent.get_message_snippet_and_body(gmail, {"id": msg_id})
+        samples.append(time.perf_counter() - start)
+        body_chars += len(data["body"])
+    return {
+        "benchmark": "parse",
+        "messages": messages,
+        "get_message_snippet_and_body": latency_summary(samples),
+        "messages_per_second": round(messages / sum(samples), 1) if samples else None,
+        "avg_body_chars": round(body_chars / max(1, messages)),
+        "memory": {"peak_rss_kb": peak_rss_kb()}
+    }
+
+def bench_gemini(calls: int, gemini_latency: float) -> dict:
+    # call_gemini_for_structured with a fake model, so the result is the agent's own overhead
+    # (prompt building, rate limiter, JSON parsing) on top of the configured latency.
+    gmail = FakeGmail(calls)
+    records = [agent.parse_message(gmail.messages_by_id[msg_id]) for msg_id in gmail.order]
+    saved = (agent._clients["gemini"], agent.gemini_limiter)
+    agent._clients["gemini"] = FakeGemini(gemini_latency)
+    agent.gemini_limiter = agent.TokenBucket(1e9, 1_000_000)
+    try:
+        samples = []
+        for data in records:
+            start = time.perf_counter()
+            agent.call_gemini_for_structured(data["subject"], data["from"], data["body"])
+            samples.append(time.perf_counter() - start)
+    finally:
+        agent._clients["gemini"], agent.gemini_limiter = saved
+    summary = latency_summary(samples)
+    return {
+        "benchmark": "gemini",
+        "calls": calls,
+        "gemini_latency_s": gemini_latency,
+        "call_gemini_for_structured": summary,
+        "overhead_p50_ms": round(summary["p50_ms"] - gemini_latency * 1000, 3)
+    }
+
+def seed_email_logs(collection, documents: int, chunk: int = 5000):
+    categories = email_stats.CATEGORIES
+    now = int(time.time())
+    for start in range(0, documents, chunk):
+        collection.insert_many([
+            {
+                "message_id": f"seed-{i:010d}",
+                "account": "me@example.com",
+                "from": f"Sender {i % 97} <sender{i % 97}@example.com>",
+                "to": "me@example.com",
+                "date": "Mon, 1 Sep 2025 10:00:00 +0530",
+                "subject": f"Seeded email {i}",
+                "snippet": "Seeded snippet text " * 5,
+                "body": "Seeded body text. " * 200,
+                "ai_reply": {"subject": f"Re: Seeded email {i}", "body": "Thanks, noted. " * 20} if i % 3 == 0 else None,
+                "action_status": "Email processed, marked as read.",
+                "ai_category": categories[i % len(categories)],
+                "processed_at": now - (documents - i)
+            }
+            for i in range(start, min(documents, start + chunk))
+        ])
+
+def bench_app(documents: int, pages: int, page_size: int, stats_requests: int, mongo: str = "uri") -> dict:
+    # Load test for the dashboard API with a large email_logs collection, through Flask's test client.
+    if mongo == "mongomock":
+        os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+    import app as dashboard
+    use_mongo(mongo)
+    db = agent.get_db()
+    saved = (dashboard.logs, dashboard.stats)
+    dashboard.logs, dashboard.stats = db["email_logs"], db["email_stats"]
+    try:
+        agent.ensure_indexes()
+        start = time.perf_counter()
+        seed_email_logs(dashboard.logs, documents)
+        email_stats.rebuild_stats(dashboard.logs, dashboard.stats)
+        seed_seconds = time.perf_counter() - start
+
+        http = dashboard.app.test_client()
+        page_samples, stats_samples, conditional_samples = [], [], []
+        cursor, etag, seen = None, None, 0
+        for _ in range(pages):
+            url = f"/api/emails?limit={page_size}" + (f"&cursor={cursor}" if cursor else "")
+            start = time.perf_counter()
+            resp = http.get(url)
+            page_samples.append(time.perf_counter() - start)
+            body = resp.get_json()
+            seen += len(body["emails"])
+            etag = etag or resp.headers.get("ETag")
+            cursor = body["next_cursor"]
+            if not cursor:
+                break
+        for _ in range(stats_requests):
+            start = time.perf_counter()
+            http.get("/api/stats")
+            stats_samples.append(time.perf_counter() - start)
+        for _ in range(stats_requests):
+            start = time.perf_counter()
+            resp = http.get(f"/api/emails?limit={page_size}", headers={"If-None-Match": etag})
+            conditional_samples.append(time.perf_counter() - start)
+
+        return {
+            "benchmark": "app",
+            "documents": documents,
+            "seed_s": round(seed_seconds, 3),
+            "page_size": page_size,
+            "emails_listed": seen,
+            "api_emails": latency_summary(page_samples),
+            "api_emails_304": latency_summary(conditional_samples),
+            "api_emails_304_status": resp.status_code if conditional_samples else None,
+            "api_stats": latency_summary(stats_samples),
+            "requests_per_second": round(
+                (len(page_samples) + len(stats_samples) + len(conditional_samples))
+                / max(1e-9, sum(page_samples) + sum(stats_samples) + sum(conditional_samples)), 1),
+            "memory": {"peak_rss_kb": peak_rss_kb()}
+        }
+    finally:
+        dashboard.logs, dashboard.stats = saved
+        agent.get_client().drop_database(agent.MONGO_DB_NAME)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gmail AI agent benchmarks")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--output", help="also write the JSON result to this file")
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = sub.add_parser("persistence", parents=[common], help="per-message MongoDB time, one-by-one vs batched")
+    p.add_argument("--messages", type=int, default=2000)
+    p.add_argument("--batch-size", type=int, default=20)
+    p.add_argument("--mongo", choices=["uri", "mongomock"], default="uri")
+
+    p = sub.add_parser("pipeline", parents=[common], help="end-to-end emails/s and per-stage latency against fake Google services")
+    p.add_argument("--messages", type=int, default=500)
+    p.add_argument("--gemini-latency", type=float, default=0.3, help="seconds per fake Gemini request")
+    p.add_argument("--gmail-latency", type=float, default=0.02, help="seconds per fake Gmail/Calendar request or batch")
+    p.add_argument("--classify-workers", type=int, default=agent.CLASSIFY_WORKERS)
+    p.add_argument("--act-workers", type=int, default=agent.ACT_WORKERS)
+    p.add_argument("--batch-size", type=int, default=agent.GEMINI_BATCH_SIZE, help="emails per Gemini request")
+    p.add_argument("--gemini-rpm", type=float, default=1e6, help="Gemini rate limit (default: effectively none)")
+    p.add_argument("--mongo", choices=["uri", "mongomock"], default="uri")
+    p.add_argument("--timeout", type=float, default=600)
+
+    p = sub.add_parser("parse", parents=[common], help="get_message_snippet_and_body over synthetic MIME trees")
+    p.add_argument("--messages", type=int, default=2000)
+
+    p = sub.add_parser("gemini", parents=[common], help="call_gemini_for_structured overhead with a fake model")
+    p.add_argument("--calls", type=int, default=50)
+    p.add_argument("--gemini-latency", type=float, default=0.2)
+
+    p = sub.add_parser("app", parents=[common], help="load test /api/emails and /api/stats on a large email_logs collection")
+    p.add_argument("--documents", type=int, default=100000)
+    p.add_argument("--pages", type=int, default=20)
+    p.add_argument("--page-size", type=int, default=50)
+    p.add_argument("--stats-requests", type=int, default=50)
+    p.add_argument("--mongo", choices=["uri", "mongomock"], default="uri")
+    args = parser.parse_args()
+
+    if args.benchmark == "persistence":
+        result = bench_persistence(args.messages, args.batch_size, args.mongo)
+    elif args.benchmark == "pipeline":
+        result = bench_pipeline(args.messages, args.gemini_latency, args.gmail_latency, args.classify_workers,
+                                args.act_workers, args.batch_size, args.gemini_rpm, args.mongo, args.timeout)
+    elif args.benchmark == "parse":
+        result = bench_parse(args.messages)
+    elif args.benchmark == "gemini":
+        result = bench_gemini(args.calls, args.gemini_latency)
+    else:
+        result = bench_app(args.documents, args.pages, args.page_size, args.stats_requests, args.mongo)
+    result["run"] = {"timestamp": int(time.time()), "python": platform.python_version(), "host": platform.node()}
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
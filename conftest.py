@@ -0,0 +1,34 @@
+# conftest.py
+# Shared fixtures for the tests. Gmail, Calendar and Gemini come from the benchmark fakes and
+# Mongo is mongomock, so the suite runs without Google credentials or a database server.
+import os
+
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.environ["MONGO_DB_NAME"] = "email_agent_test"
+
+import benchmark
+import gmail_ai_agent as agent
+
+
+@pytest.fixture
+def mongo():
+    pytest.importorskip("mongomock")
+    benchmark.use_mongo("mongomock")
+    agent._classification_lru = agent.LRUCache(agent.CLASSIFICATION_CACHE_SIZE)
+    db = agent.get_db()
+    yield db
+    agent.get_client().drop_database(agent.MONGO_DB_NAME)
+
+@pytest.fixture
+def gmail(monkeypatch):
+    service = benchmark.FakeGmail(8)
+    monkeypatch.setattr(agent, "build_gmail_service", lambda creds: service)
+    # Services are cached per thread by id(creds), and ids are reused once a test's creds are freed.
+    monkeypatch.setattr(agent._thread_local, "gmail_services", {}, raising=False)
+    return service
+
+@pytest.fixture
+def account(gmail):
+    return agent.Account(gmail.user_email, creds=object())
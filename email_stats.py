@@ -0,0 +1,96 @@
+# email_stats.py
+# Materialized dashboard counters in the email_stats collection.
+# The agent increments them when it logs an email, app.py decrements them on delete,
+# so /api/stats reads one document instead of scanning email_logs.
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+from pymongo import UpdateOne, ASCENDING
+from pymongo.errors import BulkWriteError
+
+CATEGORIES = ("interview", "meeting", "important_email", "not_important", "other")
+TOTALS_ID = "totals"
+BUCKETS = {
+    "hour": "%Y-%m-%dT%H",
+    "day": "%Y-%m-%d",
+}
+
+
+def normalize_category(category: Optional[str]) -> str:
+    return category if category in CATEGORIES else "other"
+
+def bucket_start(processed_at: int, kind: str) -> int:
+    dt = datetime.fromtimestamp(processed_at, tz=timezone.utc)
+    dt = dt.replace(minute=0, second=0, microsecond=0)
+    if kind == "day":
+        dt = dt.replace(hour=0)
+    return int(dt.timestamp())
+
+def stats_updates(category: Optional[str], processed_at: int, delta: int = 1) -> List[UpdateOne]:
+    inc = {"total": delta, f"categories.{normalize_category(category)}": delta}
+    ops = [UpdateOne({"_id": TOTALS_ID}, {"$inc": inc}, upsert=True)]
+    for kind, fmt in BUCKETS.items():
+        start = bucket_start(processed_at, kind)
+        key = datetime.fromtimestamp(start, tz=timezone.utc).strftime(fmt)
+        ops.append(UpdateOne(
+            {"_id": f"{kind}:{key}"},
+            {"$inc": inc, "$setOnInsert": {"kind": kind, "bucket_start": start}},
+            upsert=True
+        ))
+    return ops
+
+def read_totals(stats_collection) -> Optional[Dict[str, Any]]:
+    doc = stats_collection.find_one({"_id": TOTALS_ID})
+    if doc is None:
+        return None
+    categories = doc.get("categories", {})
+    return {"total": doc.get("total", 0), "categories": {c: categories.get(c, 0) for c in CATEGORIES}}
+
+def aggregate_totals(logs_collection) -> Dict[str, Any]:
+    # One $group pass over email_logs; the fallback when no counters exist yet.
+    categories = {c: 0 for c in CATEGORIES}
+    for row in logs_collection.aggregate([{"$group": {"_id": "$ai_category", "count": {"$sum": 1}}}]):
+        categories[normalize_category(row["_id"])] += row["count"]
+    return {"total": sum(categories.values()), "categories": categories}
+
+def count_logs(logs_collection) -> List[Dict[str, Any]]:
+    # Every counter document (totals and buckets) as computed from email_logs.
+    docs = {TOTALS_ID: {"_id": TOTALS_ID, "total": 0, "categories": {}}}
+    for log in logs_collection.find({}, {"ai_category": 1, "processed_at": 1}):
+        category = normalize_category(log.get("ai_category"))
+        targets = [docs[TOTALS_ID]]
+        processed_at = log.get("processed_at")
+        if processed_at is not None:
+            for kind, fmt in BUCKETS.items():
+                start = bucket_start(processed_at, kind)
+                key = f"{kind}:{datetime.fromtimestamp(start, tz=timezone.utc).strftime(fmt)}"
+                targets.append(docs.setdefault(key, {"_id": key, "kind": kind, "bucket_start": start, "total": 0, "categories": {}}))
+        for doc in targets:
+            doc["total"] += 1
+            doc["categories"][category] = doc["categories"].get(category, 0) + 1
+    return list(docs.values())
+
+def seed_stats(logs_collection, stats_collection) -> Dict[str, Any]:
+    # First-start seeding, safe with several agents starting at once: each counter document is
+    # only inserted if missing, so a concurrent seed or a count already written is left alone.
+    ops = [
+        UpdateOne({"_id": doc.pop("_id")}, {"$setOnInsert": doc}, upsert=True)
+        for doc in count_logs(logs_collection)
+    ]
+    try:
+        stats_collection.bulk_write(ops, ordered=False)
+    except BulkWriteError as e:
+        # Two upserts of the same new _id can race; the loser's document already exists.
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+    return read_totals(stats_collection)
+
+def rebuild_stats(logs_collection, stats_collection) -> Dict[str, Any]:
+    # Recomputes every counter from email_logs, replacing what is there. For --rebuild-stats
+    # repairs with no agent running, not for startup.
+    docs = count_logs(logs_collection)
+    stats_collection.delete_many({})
+    stats_collection.insert_many(docs)
+    return read_totals(stats_collection)
+
+def ensure_stats_indexes(stats_collection):
+    stats_collection.create_index([("kind", ASCENDING), ("bucket_start", ASCENDING)])
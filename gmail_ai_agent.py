@@ -1,24 +1,38 @@
+import time
+_IMPORT_STARTED = time.perf_counter()
 import os
 import base64
+import copy
+import hashlib
+import heapq
 import json
-import time
+import math
 import re
+import queue
+import random
+import socket
+import threading
+from collections import Counter, OrderedDict
 from email.mime.text import MIMEText
+from html.parser import HTMLParser
 from typing import Optional, Dict, Any, List
-from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp, Request as HttplibRequest
+import httplib2
+from googleapiclient.errors import HttpError
 from dotenv import load_dotenv
-from pymongo import MongoClient
-import google.generativeai as genai
+from pymongo import MongoClient, UpdateOne, ReturnDocument, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, OperationFailure
+import email_stats
+import metrics
+from google.api_core import exceptions as google_exceptions
 from datetime import datetime, timedelta
 import pytz
 
 load_dotenv()
 
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-gemini_model = genai.GenerativeModel('gemini-2.5-flash')  
 SCOPES = [
     'https://www.googleapis.com/auth/gmail.modify',
     'https://www.googleapis.com/auth/gmail.send',
@@ -27,85 +41,420 @@ SCOPES = [
 
 
 MONGO_URI = os.getenv("MONGO_URI")
-if not MONGO_URI:
-    raise ValueError("MONGO_URI not set in .env file or environment variables")
+MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "email_agent_db")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "32"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "2"))
+# "1" acknowledges on the primary only; set "majority" when losing a log entry on failover matters.
+MONGO_WRITE_CONCERN = os.getenv("MONGO_WRITE_CONCERN", "1")
+
+# Clients are created on first use, so importing this module (for a CLI flag, the benchmark
+# or a test) needs neither MONGO_URI nor GEMINI_API_KEY and opens no connection.
+_clients = {"mongo": None, "gemini": None}
+_clients_lock = threading.Lock()
+
+def get_client() -> MongoClient:
+    if _clients["mongo"] is None:
+        with _clients_lock:
+            if _clients["mongo"] is None:
+                if not MONGO_URI:
+                    raise ValueError("MONGO_URI not set in .env file or environment variables")
+                _clients["mongo"] = MongoClient(
+                    MONGO_URI,
+                    maxPoolSize=MONGO_MAX_POOL_SIZE,
+                    minPoolSize=MONGO_MIN_POOL_SIZE,
+                    w=int(MONGO_WRITE_CONCERN) if MONGO_WRITE_CONCERN.isdigit() else MONGO_WRITE_CONCERN,
+                    retryWrites=True,
+                    appname="gmail-ai-agent"
+                )
+    return _clients["mongo"]
+
+def get_db():
+    return get_client()[MONGO_DB_NAME]
+
+def close_client():
+    with _clients_lock:
+        if _clients["mongo"] is not None:
+            _clients["mongo"].close()
+            _clients["mongo"] = None
+
+class LazyCollection:
+    """Stands in for a pymongo collection and resolves it through get_db() on first use."""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(get_db()[self.name], attr)
+
+def get_gemini_model():
+    # google.generativeai is imported here rather than at the top: it is most of this module's import time.
+    if _clients["gemini"] is None:
+        with _clients_lock:
+            if _clients["gemini"] is None:
+                import google.generativeai as genai
+                genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+                _clients["gemini"] = genai.GenerativeModel('gemini-2.5-flash')
+    return _clients["gemini"]
+
+processed_collection = LazyCollection("processed_messages")
+email_logs_collection = LazyCollection("email_logs")
+sync_state_collection = LazyCollection("sync_state")
+classification_cache_collection = LazyCollection("classification_cache")
+sender_reputation_collection = LazyCollection("sender_reputation")
+email_stats_collection = LazyCollection("email_stats")
+accounts_collection = LazyCollection("accounts")
+outbox_collection = LazyCollection("outbox")
+calendar_events_collection = LazyCollection("calendar_events")
+backfill_jobs_collection = LazyCollection("backfill_jobs")
+dry_run_logs_collection = LazyCollection("dry_run_logs")
 
-client = MongoClient(MONGO_URI)
-db = client["email_agent_db"]
-processed_collection = db["processed_messages"]
-email_logs_collection = db["email_logs"] 
+_stats = Counter()
+_stats_lock = threading.Lock()
+# Names written with set_stat, exported as gauges rather than counters.
+_gauge_stats = set()
 
+def bump_stat(name: str, value=1):
+    with _stats_lock:
+        _stats[name] += value
+
+def set_stat(name: str, value):
+    with _stats_lock:
+        _stats[name] = value
+        _gauge_stats.add(name)
+
+def get_stats() -> Dict[str, Any]:
+    with _stats_lock:
+        return dict(_stats)
+
+INBOX_QUERY = "is:unread is:important"
+INBOX_LABELS = {"UNREAD", "IMPORTANT"}
+
+
+# processed_messages doubles as the work queue shared by every agent process.
+# status: pending (listed, unclaimed) -> claimed (owner + lease) -> done | failed.
+# Documents written before leases existed have no status and count as done.
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+LEASE_SECONDS = int(os.getenv("LEASE_SECONDS", "300"))
+CLAIM_BATCH_SIZE = int(os.getenv("CLAIM_BATCH_SIZE", "20"))
+# A released message waits MESSAGE_RETRY_BASE seconds, doubling per attempt, before it can be
+# claimed again, so its attempts span a short Gemini or Gmail outage instead of running back to back.
+MESSAGE_RETRY_BASE = float(os.getenv("MESSAGE_RETRY_BASE", "30"))
+MESSAGE_RETRY_MAX = float(os.getenv("MESSAGE_RETRY_MAX", "900"))
+UNFINISHED_STATUSES = ["pending", "claimed"]
 
 def mark_processed(msg_id: str):
-    doc = {"_id": msg_id, "processed_at": int(time.time())}
+    doc = {"_id": msg_id, "status": "done", "owner": WORKER_ID, "processed_at": int(time.time())}
     processed_collection.insert_one(doc)
 
 def is_processed(msg_id: str) -> bool:
-    return processed_collection.find_one({"_id": msg_id}) is not None
+    return processed_collection.find_one({"_id": msg_id, "status": {"$nin": UNFINISHED_STATUSES}}) is not None
+
+def processed_ids(msg_ids: List[str]) -> set:
+    # One $in query for the whole candidate list instead of a find_one per message.
+    if not msg_ids:
+        return set()
+    query = {"_id": {"$in": list(msg_ids)}, "status": {"$nin": UNFINISHED_STATUSES}}
+    return {doc["_id"] for doc in processed_collection.find(query, {"_id": 1})}
+
+def enqueue_messages(mailbox: str, msgs: List[Dict[str, Any]]):
+    # Adds newly listed messages as pending work. $setOnInsert leaves messages that are
+    # already queued, claimed or done untouched, so every worker can enqueue what it lists.
+    now = int(time.time())
+    bulk_write_ignoring_duplicates(processed_collection, [
+        UpdateOne(
+            {"_id": m["id"]},
+            {"$setOnInsert": {"status": "pending", "mailbox": mailbox, "thread_id": m.get("threadId"),
+                              "attempts": 0, "discovered_at": now}},
+            upsert=True
+        )
+        for m in msgs
+    ])
+
+def claim_messages(mailbox: str, limit: int = CLAIM_BATCH_SIZE) -> List[Dict[str, Any]]:
+    # Atomically takes up to `limit` pending messages, or claims whose lease expired because
+    # their owner crashed. Only the worker whose find_one_and_update matched may act on a message.
+    claimed = []
+    while len(claimed) < limit:
+        now = int(time.time())
+        doc = processed_collection.find_one_and_update(
+            {"mailbox": mailbox, "$or": [
+                {"status": "pending", "next_attempt_at": {"$not": {"$gt": now}}},
+                {"status": "claimed", "lease_expires_at": {"$lt": now}}
+            ]},
+            {"$set": {"status": "claimed", "owner": WORKER_ID, "claimed_at": now,
+                      "lease_expires_at": now + LEASE_SECONDS},
+             "$inc": {"attempts": 1}},
+            sort=[("discovered_at", ASCENDING)],
+            return_document=ReturnDocument.BEFORE
+        )
+        if doc is None:
+            break
+        if doc["status"] == "claimed":
+            print(f"Reclaimed message {doc['_id']} from {doc.get('owner')} after its lease expired.")
+            bump_stat("leases_reclaimed")
+        bump_stat("messages_claimed")
+        claimed.append({"id": doc["_id"], "threadId": doc.get("thread_id")})
+    return claimed
 
+def renew_lease(msg_id: str) -> bool:
+    # Checked right before a message's side effects: False means another worker has taken it over.
+    now = int(time.time())
+    result = processed_collection.update_one(
+        {"_id": msg_id, "status": "claimed", "owner": WORKER_ID},
+        {"$set": {"lease_expires_at": now + LEASE_SECONDS}}
+    )
+    if not result.matched_count:
+        bump_stat("leases_lost")
+    return bool(result.matched_count)
 
-def store_email_and_reply(data: Dict[str, Any], reply_template: Dict[str, Any], action_status: str):
+def release_claim(msg_id: str, max_attempts: int) -> bool:
+    # Hands a failed message back to the queue after a backoff, or parks it as failed once it has
+    # used up its attempts across all workers (--retry-failed-messages queues it again).
+    # Returns True if it will be retried.
+    owned = {"_id": msg_id, "status": "claimed", "owner": WORKER_ID}
+    now = int(time.time())
+    if processed_collection.update_one(
+        dict(owned, attempts={"$gte": max_attempts}),
+        {"$set": {"status": "failed", "processed_at": now}, "$unset": {"lease_expires_at": ""}}
+    ).matched_count:
+        return False
+    doc = processed_collection.find_one(owned, {"attempts": 1})
+    if doc is None:
+        # Another worker has taken the message over.
+        return True
+    delay = min(MESSAGE_RETRY_MAX, MESSAGE_RETRY_BASE * (2 ** (max(doc.get("attempts", 1), 1) - 1)))
+    processed_collection.update_one(owned, {"$set": {"status": "pending", "next_attempt_at": int(now + delay)},
+                                            "$unset": {"owner": "", "lease_expires_at": ""}})
+    return True
+
+def bulk_write_ignoring_duplicates(collection, ops: list) -> set:
+    # Unordered, so one duplicate (a message saved by an earlier attempt) does not stop the rest.
+    # Returns the indexes of the ops that upserted a new document.
+    if not ops:
+        return set()
+    try:
+        return set(collection.bulk_write(ops, ordered=False).upserted_ids)
+    except BulkWriteError as e:
+        errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+        if errors or e.details.get("writeConcernErrors"):
+            raise
+        return {item["index"] for item in e.details.get("upserted", [])}
+
+def ensure_message_id_index():
+    # persist_results dedupes logs with upserts on message_id, which is only race-free (two workers
+    # persisting the same message after a lease takeover) when the index is unique. Databases
+    # created before that have a plain index under the same name, which is replaced.
+    existing = email_logs_collection.index_information().get("message_id_1")
+    if existing is not None and not existing.get("unique"):
+        email_logs_collection.drop_index("message_id_1")
+    try:
+        email_logs_collection.create_index("message_id", unique=True)
+    except OperationFailure as e:
+        if e.code != 11000:
+            raise
+        print("email_logs holds duplicate message_id entries; remove them so the unique index can be built.")
+        email_logs_collection.create_index("message_id")
+
+def ensure_indexes():
+    email_logs_collection.create_index([("processed_at", DESCENDING), ("_id", DESCENDING)])
+    email_logs_collection.create_index([("ai_category", ASCENDING), ("processed_at", DESCENDING)])
+    ensure_message_id_index()
+    email_logs_collection.create_index([("account", ASCENDING), ("processed_at", DESCENDING), ("_id", DESCENDING)])
+    processed_collection.create_index("processed_at")
+    processed_collection.create_index([("mailbox", ASCENDING), ("status", ASCENDING), ("discovered_at", ASCENDING)])
+    outbox_collection.create_index([("status", ASCENDING), ("next_attempt_at", ASCENDING)])
+    dry_run_logs_collection.create_index("message_id", unique=True)
+    email_stats.ensure_stats_indexes(email_stats_collection)
+    ensure_cache_indexes()
+
+def ensure_stats():
+    # Seeds the dashboard counters from existing history the first time the agent runs.
+    if email_stats.read_totals(email_stats_collection) is None:
+        totals = email_stats.seed_stats(email_logs_collection, email_stats_collection)
+        print(f"Built dashboard counters for {totals['total']} logged emails.")
+
+def get_history_id(user_email: str) -> Optional[str]:
+    doc = sync_state_collection.find_one({"_id": user_email})
+    return doc.get("history_id") if doc else None
+
+def save_history_id(user_email: str, history_id: str):
+    sync_state_collection.update_one(
+        {"_id": user_email},
+        {"$set": {"history_id": str(history_id), "updated_at": int(time.time())}},
+        upsert=True
+    )
+
+
+def build_email_log(data: Dict[str, Any], reply_template: Dict[str, Any], action_status: str, structured: Dict[str, Any]=None):
+    structured = structured or {}
     email_log = {
         "message_id": data["id"],
+        "account": data.get("account"),
         "from": data["from"],
         "to": data["to"],
         "date": data["date"],
         "subject": data["subject"],
+        "snippet": data.get("snippet", ""),
         "body": data["body"],
         "ai_reply": {
             "subject": reply_template.get("subject") or f"Re: {data['subject']}",
             "body": reply_template.get("body") or "Thank you for your email. I have received it and will get back to you shortly."
         } if reply_template.get("should_reply") else None,
         "action_status": action_status,
+        "ai_category": structured.get("category"),
+        "ai_confidence": structured.get("confidence"),
+        "ai_action": structured.get("action"),
+        "classified_by": structured.get("classified_by"),
+        "triage_headers": data.get("triage_headers"),
+        "trace_id": data.get("trace_id"),
         "processed_at": int(time.time())
     }
+    return email_log
+
+def store_email_and_reply(data: Dict[str, Any], reply_template: Dict[str, Any], action_status: str, structured: Dict[str, Any]=None):
+    email_log = build_email_log(data, reply_template, action_status, structured)
     email_logs_collection.insert_one(email_log)
+    email_stats_collection.bulk_write(email_stats.stats_updates(email_log["ai_category"], email_log["processed_at"]))
+
+def persist_results(results: List[tuple], actions: List[Dict[str, Any]] = None):
+    # Saves a whole cycle of (data, reply_template, action_status, structured) tuples with one
+    # bulk write per collection. Logs go first so a message is never marked processed without one,
+    # and are upserted on message_id so a retried cycle does not log a message twice.
+    # Outbox actions are written before the messages are marked processed, so none is lost.
+    now = int(time.time())
+    actions = actions or []
+    email_logs = [build_email_log(data, reply_template, action_status, structured)
+                  for data, reply_template, action_status, structured in results]
+    planned: Dict[str, Dict[str, str]] = {}
+    for action in actions:
+        planned.setdefault(action["message_id"], {})[action["type"]] = "queued"
+    for log in email_logs:
+        if log["message_id"] in planned:
+            log["actions"] = planned[log["message_id"]]
+    inserted = bulk_write_ignoring_duplicates(email_logs_collection, [
+        UpdateOne({"message_id": log["message_id"]}, {"$setOnInsert": log}, upsert=True)
+        for log in email_logs
+    ])
+    # Only newly inserted logs count towards the dashboard totals.
+    stats_ops = []
+    for i in sorted(inserted):
+        stats_ops.extend(email_stats.stats_updates(email_logs[i]["ai_category"], email_logs[i]["processed_at"]))
+    if stats_ops:
+        email_stats_collection.bulk_write(stats_ops, ordered=False)
+    enqueue_actions(actions)
+    bulk_write_ignoring_duplicates(processed_collection, [
+        UpdateOne(
+            {"_id": data["id"]},
+            {"$set": {"status": "done", "owner": WORKER_ID, "processed_at": now},
+             "$unset": {"lease_expires_at": ""}},
+            upsert=True
+        )
+        for data, _, _, _ in results
+    ])
+
+def persist_dry_run(results: List[tuple], actions: List[Dict[str, Any]]):
+    # Dry runs keep their logs apart from email_logs and the dashboard counters, with the actions
+    # that would have been queued, and leave processed_messages alone so a real run still sees the mail.
+    planned: Dict[str, List[Dict[str, Any]]] = {}
+    for action in actions:
+        planned.setdefault(action["message_id"], []).append({"type": action["type"], "payload": action["payload"]})
+    ops = []
+    for data, reply_template, action_status, structured in results:
+        log = build_email_log(data, reply_template, action_status, structured)
+        log["planned_actions"] = planned.get(log["message_id"], [])
+        ops.append(UpdateOne({"message_id": log["message_id"]}, {"$set": log}, upsert=True))
+    bulk_write_ignoring_duplicates(dry_run_logs_collection, ops)
 
-def gmail_authenticate():
+def gmail_authenticate(interactive: bool = True):
+    # One service build and one getProfile. With interactive=False there is no prompt and no
+    # browser: a missing or unusable token.json is an error, so restarts never hang on input.
     creds = None
+    existing_token = os.path.exists('token.json')
     
-    if os.path.exists('token.json'):
+    if existing_token:
         try:
             creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-            temp_service = build('gmail', 'v1', credentials=creds, cache_discovery=False)
-            profile = temp_service.users().getProfile(userId='me').execute()
-            user_email = profile.get('emailAddress')
-            print(f"\nAuthenticated with: {user_email}")
-            
-            switch = input("\nA token file already exists. Switch account? (yes/no): ").lower()
-            if switch == 'yes':
-                os.remove('token.json')
-                print("Existing token deleted. A new authentication window will open.")
-                creds = None
         except Exception as e:
+            # A headless process cannot write a new token, so it leaves the file for an operator to inspect.
+            if not interactive:
+                raise RuntimeError(f"token.json could not be read ({e}). Run once without --non-interactive to authorize.") from e
             print("Existing token is invalid. Proceeding with new authentication.")
-            if os.path.exists('token.json'):
-                os.remove('token.json')
+            os.remove('token.json')
             creds = None
     
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             try:
-                creds.refresh(Request())
+                creds.refresh(HttplibRequest(httplib2.Http()))
             except Exception as e:
                 print(f"Failed to refresh token: {e}")
                 creds = None
         if not creds:
+            if not interactive:
+                raise RuntimeError("No usable token.json. Run once without --non-interactive to authorize.")
             if not os.path.exists('credentials.json'):
                 raise FileNotFoundError("credentials.json not found. Create OAuth credentials in Google Cloud and download credentials.json")
             flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
             creds = flow.run_local_server(port=0)
+            existing_token = False
         
         with open('token.json', 'w') as token:
             token.write(creds.to_json())
     
-    service = build('gmail', 'v1', credentials=creds, cache_discovery=False)
+    # Cached for this thread, so the main loop's first poll reuses this service.
+    service = get_gmail_service(creds)
     profile = service.users().getProfile(userId='me').execute()
     user_email = profile.get('emailAddress')
     print(f"\nAuthenticated with Gmail as: {user_email}")
+
+    if interactive and existing_token:
+        switch = input("\nA token file already exists. Switch account? (yes/no): ").lower()
+        if switch == 'yes':
+            os.remove('token.json')
+            print("Existing token deleted. A new authentication window will open.")
+            return gmail_authenticate(interactive)
     
     return service, creds, user_email
 
+class Account:
+    """A mailbox served by the agent: the address it replies as and the credentials for it."""
+
+    def __init__(self, user_email: str, creds):
+        self.user_email = user_email
+        self.creds = creds
+
+def save_account(user_email: str, creds):
+    now = int(time.time())
+    accounts_collection.update_one(
+        {"_id": user_email},
+        {"$set": {"token": creds.to_json(), "enabled": True, "updated_at": now},
+         "$setOnInsert": {"added_at": now}},
+        upsert=True
+    )
+
+def add_account(token_file: str = None) -> str:
+    # Stores a mailbox's OAuth token in the accounts collection for multi-account mode,
+    # either from an existing token.json or through the browser consent flow.
+    if token_file:
+        creds = Credentials.from_authorized_user_file(token_file, SCOPES)
+    else:
+        if not os.path.exists('credentials.json'):
+            raise FileNotFoundError("credentials.json not found. Create OAuth credentials in Google Cloud and download credentials.json")
+        flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
+        creds = flow.run_local_server(port=0)
+    if not creds.valid and creds.refresh_token:
+        creds.refresh(HttplibRequest(httplib2.Http()))
+    user_email = build_gmail_service(creds).users().getProfile(userId='me').execute()['emailAddress']
+    save_account(user_email, creds)
+    return user_email
+
+def load_account(doc: Dict[str, Any]) -> Account:
+    creds = Credentials.from_authorized_user_info(json.loads(doc["token"]), SCOPES)
+    if not creds.valid and creds.refresh_token:
+        creds.refresh(HttplibRequest(httplib2.Http()))
+        save_account(doc["_id"], creds)
+    return Account(doc["_id"], creds)
+
 def extract_email_address(from_header: str) -> str:
     m = re.search(r'<([^>]+)>', from_header)
     if m:
@@ -113,41 +462,213 @@ def extract_email_address(from_header: str) -> str:
     m2 = re.search(r'[\w\.-]+@[\w\.-]+', from_header)
     return m2.group(0) if m2 else from_header
 
-def get_message_snippet_and_body(service, message) -> Dict[str, Any]:
-    msg_id = message['id']
+GMAIL_BATCH_SIZE = 50
+METADATA_HEADERS = ['Subject', 'From', 'To', 'Date', 'Message-ID', 'List-Unsubscribe', 'Precedence', 'Auto-Submitted']
+# Partial-response masks: metadata skips labels and size. The full phase still needs the payload
+# headers, because a single-part message declares its charset (Content-Type) there.
+METADATA_FIELDS = 'id,threadId,snippet,payload/headers'
+FULL_FIELDS = 'id,payload(mimeType,headers,body/data,parts)'
+# Headers the local pre-classifier looks at, lower-cased.
+TRIAGE_HEADERS = ('list-unsubscribe', 'precedence', 'auto-submitted')
+
+_thread_local = threading.local()
+
+class CountingHttp(httplib2.Http):
+    # Counts response bytes process-wide and per thread, so a caller can measure its own share.
+    def request(self, *args, **kwargs):
+        resp, content = super().request(*args, **kwargs)
+        size = len(content or b'')
+        bump_stat("gmail_bytes_received", size)
+        _thread_local.bytes_received = getattr(_thread_local, 'bytes_received', 0) + size
+        return resp, content
+
+def thread_bytes_received() -> int:
+    return getattr(_thread_local, 'bytes_received', 0)
+
+def current_rss_kb() -> Optional[int]:
+    # Resident memory right now. ru_maxrss is the peak over the whole process lifetime and never
+    # drops after one large cycle. Linux only; None elsewhere.
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def build_gmail_service(creds):
+    http = AuthorizedHttp(creds, http=CountingHttp())
+    # static_discovery reads the discovery document bundled with googleapiclient instead of fetching it.
+    return build('gmail', 'v1', http=http, cache_discovery=False, static_discovery=True)
+
+def get_gmail_service(creds):
+    # A googleapiclient service wraps a single httplib2.Http, which is not thread-safe,
+    # so each worker thread builds and keeps its own.
+    services = getattr(_thread_local, 'gmail_services', None)
+    if services is None:
+        services = _thread_local.gmail_services = {}
+    if id(creds) not in services:
+        services[id(creds)] = build_gmail_service(creds)
+    return services[id(creds)]
+
+def empty_message_record(msg_id: str, error: str = None) -> Dict[str, Any]:
+    # `fetch_error` marks a message that could not be fetched or decoded; callers must not
+    # classify or act on it, only retry it later.
+    return {
+        "fetch_error": error or "not fetched",
+        "id": msg_id,
+        "thread_id": "",
+        "snippet": "",
+        "subject": "",
+        "from": "",
+        "from_email": "",
+        "to": "",
+        "date": "",
+        "message_id_header": "",
+        "triage_headers": {},
+        "body": ""
+    }
+
+MAX_BODY_CHARS = int(os.getenv("MAX_BODY_CHARS", "20000"))
+PROMPT_BODY_TOKENS = int(os.getenv("PROMPT_BODY_TOKENS", "1500"))
+# Rough average for English text; only used to turn the token budget into a character budget.
+CHARS_PER_TOKEN = 4
+_CHARSET_RE = re.compile(r'charset="?([\w.:-]+)', re.I)
+_QUOTE_HEADER_RE = re.compile(r'^(On\b.*\bwrote:|-{2,}\s*Original Message\s*-{2,}|_{10,})\s*$', re.I)
+_SIGNATURE_RE = re.compile(r'^(--\s?|Sent from my \w+.*)$')
+_BLANK_LINES_RE = re.compile(r'\n\s*\n\s*\n+')
+
+class _HTMLTextExtractor(HTMLParser):
+    # Single pass over the markup: drops scripts, styles and quoted blocks, decodes entities.
+    SKIP = {'script', 'style', 'head', 'blockquote'}
+    BLOCK = {'p', 'div', 'br', 'li', 'tr', 'table', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self.skip_depth += 1
+        elif tag in self.BLOCK:
+            self.chunks.append('\n')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in self.BLOCK:
+            self.chunks.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in self.BLOCK:
+            self.chunks.append('\n')
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.chunks.append(data)
+
+def html_to_text(html: str) -> str:
+    parser = _HTMLTextExtractor()
+    parser.feed(html)
+    parser.close()
+    lines = (' '.join(line.split()) for line in ''.join(parser.chunks).splitlines())
+    return _BLANK_LINES_RE.sub('\n\n', '\n'.join(lines)).strip()
+
+def strip_quoted_text(text: str) -> str:
+    # Cuts quoted reply chains and signatures; keeps the original if nothing would be left.
+    lines = text.splitlines()
+    kept = []
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if _QUOTE_HEADER_RE.match(stripped) or _SIGNATURE_RE.match(line.rstrip('\r')):
+            break
+        # Outlook style "From: ... / Sent: ..." header block
+        if stripped.startswith('From:') and i + 1 < len(lines) and lines[i + 1].strip().startswith(('Sent:', 'Date:')):
+            break
+        # "On <date>, <name>" wrapped onto a second line ending in "wrote:"
+        if stripped.startswith('On ') and i + 1 < len(lines) and lines[i + 1].strip().endswith('wrote:'):
+            break
+        if stripped.startswith('>'):
+            continue
+        kept.append(line)
+    result = '\n'.join(kept).strip()
+    return result or text.strip()
+
+def truncate_to_token_budget(text: str, tokens: int = PROMPT_BODY_TOKENS) -> str:
+    limit = tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    bump_stat("prompt_bodies_truncated")
+    cut = text.rfind(' ', 0, limit)
+    return text[:cut if cut > limit // 2 else limit] + "\n[... truncated]"
+
+def _iter_leaf_parts(payload: Dict[str, Any]):
+    # Depth-first over nested multiparts (e.g. alternative inside mixed) without decoding anything.
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        children = part.get('parts')
+        if children:
+            stack.extend(reversed(children))
+        else:
+            yield part
+
+def _decode_part(part: Dict[str, Any], max_chars: int = MAX_BODY_CHARS) -> str:
+    data = part.get('body', {}).get('data', '')
+    # Only decode as much base64 as the size cap needs (4 output bytes per char covers UTF-8).
+    max_b64 = ((max_chars * 4 + 2) // 3) * 4
+    raw = base64.urlsafe_b64decode(data[:max_b64] + '=' * (-min(len(data), max_b64) % 4))
+    content_type = next((h['value'] for h in part.get('headers', []) if h['name'].lower() == 'content-type'), '')
+    m = _CHARSET_RE.search(content_type)
+    charset = m.group(1) if m else 'utf-8'
+    try:
+        text = raw.decode(charset, errors='ignore')
+    except LookupError:
+        text = raw.decode('utf-8', errors='ignore')
+    return text[:max_chars]
+
+def extract_body(payload: Dict[str, Any]) -> str:
+    # Returns the first non-empty text/plain part, else the first text/html part as text,
+    # with quoted replies and signatures removed. Attachments are skipped.
+    first_html = None
+    for part in _iter_leaf_parts(payload):
+        if part.get('filename') or not part.get('body', {}).get('data'):
+            continue
+        mime_type = part.get('mimeType', '')
+        if mime_type == 'text/plain':
+            text = _decode_part(part)
+            if text.strip():
+                return strip_quoted_text(text)
+        elif mime_type == 'text/html' and first_html is None:
+            first_html = part
+        elif payload is part:
+            # Single-part message with an unusual type: treat it as text, as before.
+            return strip_quoted_text(_decode_part(part))
+    if first_html is not None:
+        return strip_quoted_text(html_to_text(_decode_part(first_html)))
+    return ''
+
+def parse_message(full: Dict[str, Any]) -> Dict[str, Any]:
+    msg_id = full['id']
     try:
-        full = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
         headers = full.get('payload', {}).get('headers', [])
         subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), '')
         from_hdr = next((h['value'] for h in headers if h['name'].lower() == 'from'), '')
         date_hdr = next((h['value'] for h in headers if h['name'].lower() == 'date'), '')
         to_hdr = next((h['value'] for h in headers if h['name'].lower() == 'to'), '')
         message_id_hdr = next((h['value'] for h in headers if h['name'].lower() == 'message-id'), '')
+        triage_headers = {
+            name.replace('-', '_'): next((h['value'] for h in headers if h['name'].lower() == name), '')
+            for name in TRIAGE_HEADERS
+        }
         
         snippet = full.get('snippet', '')
         
-        parts = full.get('payload', {}).get('parts', [])
-        body = ''
-        if parts:
-            for p in parts:
-                if p.get('mimeType') == 'text/plain' and p.get('body', {}).get('data'):
-                    data = p['body']['data']
-                    body = base64.urlsafe_b64decode(data).decode('utf-8', errors='ignore')
-                    break
-            if not body:
-                for p in parts:
-                    if p.get('mimeType') == 'text/html' and p.get('body', {}).get('data'):
-                        data = p['body']['data']
-                        body_html = base64.urlsafe_b64decode(data).decode('utf-8', errors='ignore')
-                        body = re.sub('<[^<]+?>', '', body_html)
-                        break
-        else:
-            body_data = full.get('payload', {}).get('body', {}).get('data')
-            if body_data:
-                body = base64.urlsafe_b64decode(body_data).decode('utf-8', errors='ignore')
+        body = extract_body(full.get('payload', {}))
 
         return {
             "id": msg_id,
+            "thread_id": full.get('threadId', ''),
             "snippet": snippet,
             "subject": subject,
             "from": from_hdr,
@@ -155,28 +676,78 @@ def get_message_snippet_and_body(service, message) -> Dict[str, Any]:
             "to": to_hdr,
             "date": date_hdr,
             "message_id_header": message_id_hdr,
+            "triage_headers": triage_headers,
             "body": body
         }
     except Exception as e:
         print(f"Error decoding message {msg_id}: {e}")
-        return {
-            "id": msg_id,
-            "snippet": "",
-            "subject": "",
-            "from": "",
-            "from_email": "",
-            "to": "",
-            "date": "",
-            "message_id_header": "",
-            "body": ""
-        }
+        return empty_message_record(msg_id, str(e))
 
-EXTRA_SYSTEM = """
-You are an assistant that reads a plain-text email and returns EXACTLY one JSON object (no extra text).
-The JSON must match the schema below (keys must exist; set values to null if not applicable).
+def get_message_snippet_and_body(service, message) -> Dict[str, Any]:
+    msg_id = message['id']
+    try:
+        full = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
+    except Exception as e:
+        print(f"Error fetching message {msg_id}: {e}")
+        return empty_message_record(msg_id, str(e))
+    return parse_message(full)
 
-Schema:
-{
+def _batch_get(service, messages: List[Dict[str, Any]], on_response, **get_kwargs):
+    for i in range(0, len(messages), GMAIL_BATCH_SIZE):
+        chunk = messages[i:i + GMAIL_BATCH_SIZE]
+        batch = service.new_batch_http_request(callback=on_response)
+        for msg in chunk:
+            batch.add(
+                service.users().messages().get(userId='me', id=msg['id'], **get_kwargs),
+                request_id=msg['id']
+            )
+        batch.execute()
+
+def get_messages_batch(service, messages: List[Dict[str, Any]], fmt: str = 'full') -> List[Dict[str, Any]]:
+    # One HTTP batch per GMAIL_BATCH_SIZE messages instead of one round trip each.
+    # Results keep the order of `messages`; a failed sub-request (often a per-request 429)
+    # yields an empty record with `fetch_error` set.
+    # fmt='metadata' returns headers and snippet only (body is left empty) for cheap triage.
+    results: Dict[str, Dict[str, Any]] = {}
+
+    def on_response(request_id, response, exception):
+        if exception is not None:
+            print(f"Error fetching message {request_id}: {exception}")
+            results[request_id] = empty_message_record(request_id, str(exception))
+        else:
+            results[request_id] = parse_message(response)
+
+    if fmt == 'metadata':
+        _batch_get(service, messages, on_response, format='metadata',
+                   metadataHeaders=METADATA_HEADERS, fields=METADATA_FIELDS)
+    else:
+        _batch_get(service, messages, on_response, format='full')
+    return [results.get(msg['id']) or empty_message_record(msg['id']) for msg in messages]
+
+def fetch_bodies(service, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # Second phase of the triage fetch: download the MIME tree only for records that need it.
+    # Records whose body could not be fetched or decoded get `fetch_error` set.
+    def on_response(request_id, response, exception):
+        if exception is not None:
+            print(f"Error fetching body of message {request_id}: {exception}")
+            by_id[request_id]['fetch_error'] = str(exception)
+            return
+        try:
+            by_id[request_id]['body'] = extract_body(response.get('payload', {}))
+            fetched.add(request_id)
+        except Exception as e:
+            print(f"Error decoding message {request_id}: {e}")
+            by_id[request_id]['fetch_error'] = str(e)
+
+    by_id = {data['id']: data for data in records}
+    fetched = set()
+    _batch_get(service, records, on_response, format='full', fields=FULL_FIELDS)
+    for data in records:
+        if data['id'] not in fetched:
+            data.setdefault('fetch_error', "no response in batch")
+    return records
+
+JSON_SCHEMA = """{
   "category": "interview" | "meeting" | "important_email" | "not_important" | "other",
   "confidence": 0.0-1.0,
   "summary": "<one-line summary>",
@@ -195,10 +766,25 @@ Schema:
          "description": "<event description|null>"
      }
   }
-}
+}"""
+EXTRA_SYSTEM = """
+You are an assistant that reads a plain-text email and returns EXACTLY one JSON object (no extra text).
+The JSON must match the schema below (keys must exist; set values to null if not applicable).
+
+Schema:
+""" + JSON_SCHEMA + """
 Return only the JSON (no markdown, no explanation).
 """
-PROMPT_TEMPLATE = """
+BATCH_SYSTEM = """
+You are an assistant that reads several plain-text emails and returns EXACTLY one JSON array (no extra text).
+The array holds one object per email. Each object has an "id" key with the email id exactly as given,
+plus every key of the schema below (keys must exist; set values to null if not applicable).
+
+Schema:
+""" + JSON_SCHEMA + """
+Return only the JSON array (no markdown, no explanation).
+"""
+EMAIL_TEMPLATE = """
 Email Subject:
 {subject}
 
@@ -207,7 +793,8 @@ From:
 
 Body:
 {body}
-
+"""
+INSTRUCTIONS = """
 Instructions:
 1) Classify the email and extract structured fields per the JSON schema.
 2) If the email is a confirmed interview or meeting, extract the event details (summary, start, end, location) from the body. Parse dates and times to ISO8601 format (e.g., 2025-09-18T10:00:00+05:30 for IST). Assume timezone is IST (Asia/Kolkata) if not specified. Set category to "interview" or "meeting" and reply_template.should_reply to true. Provide a concise, polite confirmation reply.
@@ -216,69 +803,509 @@ Instructions:
 5) If you are not confident, set confidence appropriately and prefer safe actions.
 6) Do not include any extra keys beyond the schema. Output JSON only.
 7) In End After sincerly, Name is Akhil Kushwaha. 
-Now analyze the email.
 """
+PROMPT_TEMPLATE = EMAIL_TEMPLATE + INSTRUCTIONS + "Now analyze the email.\n"
+
+FALLBACK_STRUCTURED = {
+    "category": "other",
+    "confidence": 0.0,
+    "summary": "Could not parse model output",
+    "action": "no_action",
+    "reply_template": {"should_reply": False, "subject": None, "body": None},
+    "metadata": {"calendar_event": None}
+}
+
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "60"))
+GEMINI_BURST = int(os.getenv("GEMINI_BURST", "5"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "5"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "1.0"))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "60.0"))
+GEMINI_BATCH_SIZE = int(os.getenv("GEMINI_BATCH_SIZE", "1"))
+RETRYABLE_GEMINI_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+)
+
+class GeminiUnavailableError(Exception):
+    pass
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: int = 1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Shared by every thread in the process so the combined request rate stays under GEMINI_RPM.
+gemini_limiter = TokenBucket(GEMINI_RPM / 60.0, GEMINI_BURST)
+
+def generate_with_retry(prompt: str):
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        gemini_limiter.acquire()
+        start = time.perf_counter()
+        try:
+            response = get_gemini_model().generate_content(
+                contents=[
+                    {"role": "user", "parts": [prompt]}
+                ]
+            )
+        except Exception as e:
+            metrics.observe("gemini_call", time.perf_counter() - start)
+            metrics.count_error("gemini", e)
+            if not isinstance(e, RETRYABLE_GEMINI_ERRORS):
+                raise
+            if attempt == GEMINI_MAX_RETRIES:
+                raise GeminiUnavailableError(f"Gemini still failing after {attempt + 1} attempts: {e}") from e
+            delay = random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** attempt))
+            bump_stat("gemini_retries")
+            print(f"Gemini call failed ({e}). Retrying in {delay:.1f}s...")
+            time.sleep(delay)
+            continue
+        metrics.observe("gemini_call", time.perf_counter() - start)
+        bump_stat("gemini_requests")
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is not None:
+            bump_stat("gemini_prompt_tokens", getattr(usage, 'prompt_token_count', 0) or 0)
+            bump_stat("gemini_output_tokens", getattr(usage, 'candidates_token_count', 0) or 0)
+        return response
+
+def strip_code_fences(text: str) -> str:
+    text = text.strip()
+    if text.startswith('```json'):
+        text = text[len('```json'):].strip()
+    if text.endswith('```'):
+        text = text[:-len('```')].strip()
+    return text
 
 def call_gemini_for_structured(email_subject: str, email_from: str, email_body: str) -> Dict[str, Any]:
-    prompt = PROMPT_TEMPLATE.format(subject=email_subject, from_hdr=email_from, body=email_body)
+    # Retryable API errors are retried with backoff and raise GeminiUnavailableError once
+    # exhausted, so the caller can try the message again later instead of misfiling it.
+    prompt = PROMPT_TEMPLATE.format(subject=email_subject, from_hdr=email_from, body=truncate_to_token_budget(email_body))
     
+    response = generate_with_retry(EXTRA_SYSTEM + "\n\n" + prompt)
+    bump_stat("gemini_emails")
     try:
-        response = gemini_model.generate_content(
-            contents=[
-                {"role": "user", "parts": [EXTRA_SYSTEM + "\n\n" + prompt]}
-            ]
-        )
-        
-        text = response.text.strip()
-        if text.startswith('```json'):
-            text = text[len('```json'):].strip()
-        if text.endswith('```'):
-            text = text[:-len('```')].strip()
-        
-        parsed = json.loads(text)
+        with metrics.timed("gemini_parse"):
+            parsed = json.loads(strip_code_fences(response.text))
     except Exception as e:
         print("Error parsing Gemini model output:", e)
-        parsed = {
-            "category": "other",
-            "confidence": 0.0,
-            "summary": "Could not parse model output",
-            "action": "no_action",
-            "reply_template": {"should_reply": False, "subject": None, "body": None},
-            "metadata": {"calendar_event": None}
-        }
+        bump_stat("gemini_fallbacks")
+        parsed = copy.deepcopy(FALLBACK_STRUCTURED)
     return parsed
 
-def send_reply(service, reply_to: str, subject: str, body: str, thread_id: str=None, in_reply_to: str=None, sender_email: str=None):
+def call_gemini_for_structured_batch(emails: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    # Classifies several emails with one request so the system prompt and instructions are
+    # sent once per batch instead of once per email. Emails missing from the model's answer
+    # are classified one by one.
+    if len(emails) == 1:
+        e = emails[0]
+        return {e['id']: call_gemini_for_structured(e['subject'], e['from'], e['body'])}
+
+    prompt = BATCH_SYSTEM + "\n\n"
+    for e in emails:
+        prompt += f"\n### Email id: {e['id']}\n" + EMAIL_TEMPLATE.format(subject=e['subject'], from_hdr=e['from'], body=truncate_to_token_budget(e['body']))
+    prompt += INSTRUCTIONS + "Now analyze each email and return the JSON array.\n"
+
+    response = generate_with_retry(prompt)
+    results = {}
+    try:
+        with metrics.timed("gemini_parse"):
+            items = json.loads(strip_code_fences(response.text))
+        wanted = {e['id'] for e in emails}
+        for item in items:
+            msg_id = str(item.pop('id', ''))
+            if msg_id in wanted:
+                results[msg_id] = item
+    except Exception as e:
+        print("Error parsing Gemini batch output:", e)
+    bump_stat("gemini_emails", len(results))
+
+    for e in emails:
+        if e['id'] not in results:
+            results[e['id']] = call_gemini_for_structured(e['subject'], e['from'], e['body'])
+    return results
+
+CLASSIFICATION_CACHE_SIZE = int(os.getenv("CLASSIFICATION_CACHE_SIZE", "1000"))
+CLASSIFICATION_CACHE_TTL = int(os.getenv("CLASSIFICATION_CACHE_TTL", str(7 * 24 * 3600)))
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.7"))
+MINHASH_PERMUTATIONS = 32
+MINHASH_BANDS = 8
+# Interviews and meetings carry event details that belong to one email only.
+CACHEABLE_CATEGORIES = {"important_email", "not_important", "other"}
+
+_URL_RE = re.compile(r'https?://\S+|www\.\S+')
+_EMAIL_RE = re.compile(r'[\w\.+-]+@[\w\.-]+')
+_DIGITS_RE = re.compile(r'\d+')
+_SPACE_RE = re.compile(r'\s+')
+_WORD_RE = re.compile(r'\w+')
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_rng = random.Random(1337)
+_MINHASH_PARAMS = [
+    (_minhash_rng.randrange(1, _MINHASH_PRIME), _minhash_rng.randrange(0, _MINHASH_PRIME))
+    for _ in range(MINHASH_PERMUTATIONS)
+]
+
+class LRUCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+_classification_lru = LRUCache(CLASSIFICATION_CACHE_SIZE)
+
+def normalize_text(text: str, numbers: bool = True) -> str:
+    # Drops the parts bulk senders vary per recipient: tracking links, addresses and, unless
+    # numbers=False, numbers.
+    text = _URL_RE.sub(' url ', (text or '').lower())
+    text = _EMAIL_RE.sub(' email ', text)
+    if numbers:
+        text = _DIGITS_RE.sub('0', text)
+    return _SPACE_RE.sub(' ', text).strip()
+
+def display_name(from_header: str) -> str:
+    return from_header.split('<')[0].strip().strip('"') if '<' in (from_header or '') else ''
+
+def classification_key(data: Dict[str, Any]) -> str:
+    # Exact hits reuse the whole result, summary and reply included, so amounts, dates and
+    # invoice numbers stay part of the key.
+    raw = "\n".join([data['from_email'].lower(), normalize_text(data['subject'], numbers=False),
+                     normalize_text(data['body'], numbers=False)])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def minhash(text: str) -> List[int]:
+    words = set(_WORD_RE.findall(text)) or {''}
+    hashes = [int.from_bytes(hashlib.blake2b(w.encode('utf-8'), digest_size=8).digest(), 'big') for w in words]
+    return [min((a * h + b) % _MINHASH_PRIME for h in hashes) for a, b in _MINHASH_PARAMS]
+
+def minhash_bands(signature: List[int]) -> List[str]:
+    # LSH banding: emails whose word sets overlap heavily collide in at least one band.
+    rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    return [
+        f"{i}:" + hashlib.blake2b(repr(signature[i * rows:(i + 1) * rows]).encode(), digest_size=8).hexdigest()
+        for i in range(MINHASH_BANDS)
+    ]
+
+def minhash_similarity(a: List[int], b: List[int]) -> float:
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+def rerender_cached_classification(doc: Dict[str, Any], data: Dict[str, Any]) -> Dict[str, Any]:
+    structured = copy.deepcopy(doc['structured'])
+    reply_template = structured.get('reply_template') or {}
+    if reply_template.get('subject') == f"Re: {doc['subject']}":
+        reply_template['subject'] = f"Re: {data['subject']}"
+    old_name, new_name = doc.get('from_name'), display_name(data['from'])
+    if reply_template.get('body') and old_name and new_name and old_name != new_name:
+        reply_template['body'] = reply_template['body'].replace(old_name, new_name)
+    return structured
+
+def near_duplicate_classification(doc: Dict[str, Any]) -> Dict[str, Any]:
+    # Only the verdict carries over to a near-duplicate. Its summary and any reply were written
+    # for someone else's email and may quote their details.
+    structured = doc['structured']
+    return {
+        "category": structured.get('category'),
+        "confidence": structured.get('confidence'),
+        "action": structured.get('action'),
+        "summary": "Near-duplicate of a previously classified email",
+        "reply_template": {"should_reply": False, "subject": None, "body": None},
+        "metadata": {}
+    }
+
+def lookup_cached_classification(data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    key = classification_key(data)
+    doc = _classification_lru.get(key)
+    if doc is None:
+        doc = classification_cache_collection.find_one({"_id": key})
+        if doc is not None:
+            _classification_lru.put(key, doc)
+    if doc is not None:
+        bump_stat("cache_hits_exact")
+        bump_stat("saved_model_calls")
+        return rerender_cached_classification(doc, data)
+
+    # Near-duplicates only count from the same sender address: on shared (freemail) domains
+    # a matching domain says nothing about who wrote the mail. Verdicts that came with a reply
+    # are not reused, since the reply itself cannot be.
+    signature = minhash(normalize_text(data['subject'] + ' ' + data['body']))
+    candidates = classification_cache_collection.find(
+        {"sender": data['from_email'].lower(), "bands": {"$in": minhash_bands(signature)}}
+    ).limit(20)
+    for doc in candidates:
+        if (doc['structured'].get('reply_template') or {}).get('should_reply'):
+            continue
+        if minhash_similarity(signature, doc['minhash']) >= NEAR_DUPLICATE_THRESHOLD:
+            bump_stat("cache_hits_near")
+            bump_stat("saved_model_calls")
+            return near_duplicate_classification(doc)
+
+    bump_stat("cache_misses")
+    return None
+
+def store_cached_classification(data: Dict[str, Any], structured: Dict[str, Any]):
+    if structured.get('category') not in CACHEABLE_CATEGORIES or not structured.get('confidence'):
+        return
+    signature = minhash(normalize_text(data['subject'] + ' ' + data['body']))
+    doc = {
+        "_id": classification_key(data),
+        "structured": structured,
+        "subject": data['subject'],
+        "from_name": display_name(data['from']),
+        "sender": data['from_email'].lower(),
+        "minhash": signature,
+        "bands": minhash_bands(signature),
+        "created_at": datetime.utcnow()
+    }
+    _classification_lru.put(doc["_id"], doc)
+    classification_cache_collection.replace_one({"_id": doc["_id"]}, doc, upsert=True)
+
+def ensure_cache_indexes():
+    classification_cache_collection.create_index("created_at", expireAfterSeconds=CLASSIFICATION_CACHE_TTL)
+    classification_cache_collection.create_index([("sender", 1), ("bands", 1)])
+
+PRECLASSIFY_ENABLED = os.getenv("PRECLASSIFY_ENABLED", "true").lower() == "true"
+PRECLASSIFY_THRESHOLD = float(os.getenv("PRECLASSIFY_THRESHOLD", "0.9"))
+# Naive Bayes posteriors sit near 1.0 for almost any email, so the model is off by default and,
+# when on, only counts as a weak signal next to a strong one.
+PRECLASSIFY_MODEL = os.getenv("PRECLASSIFY_MODEL", "false").lower() == "true"
+# Weights of the single signals, all below PRECLASSIFY_THRESHOLD: applicant-tracking systems send
+# interview invites from no-reply addresses with List-Unsubscribe headers, so no signal decides
+# alone. Precedence, Auto-Submitted and sender reputation are strong; the rest only back them up.
+STRONG_SIGNAL_WEIGHT = 0.8
+WEAK_SIGNAL_WEIGHT = 0.6
+REPUTATION_MIN_COUNT = int(os.getenv("REPUTATION_MIN_COUNT", "5"))
+LOCAL_MODEL_MIN_DOCS = int(os.getenv("LOCAL_MODEL_MIN_DOCS", "50"))
+LOCAL_MODEL_REFRESH = int(os.getenv("LOCAL_MODEL_REFRESH", "3600"))
+_NO_REPLY_RE = re.compile(r'^(no-?reply|do-?not-?reply|mailer-daemon|notifications?|bounce[s]?)([+.-].*)?@', re.I)
+
+class NaiveBayesClassifier:
+    """Multinomial naive Bayes over normalized subject + snippet words."""
+
+    def __init__(self):
+        self.class_docs = Counter()
+        self.word_counts: Dict[str, Counter] = {}
+        self.class_words = Counter()
+        self.vocab = set()
+
+    @staticmethod
+    def tokens(data: Dict[str, Any]) -> List[str]:
+        # Triage only has metadata records, so training and evaluation use the snippet as well.
+        return _WORD_RE.findall(normalize_text((data.get('subject') or '') + ' ' + (data.get('snippet') or '')))
+
+    def fit(self, docs: List[Dict[str, Any]], labels: List[str]):
+        for doc, label in zip(docs, labels):
+            words = self.tokens(doc)
+            self.class_docs[label] += 1
+            self.word_counts.setdefault(label, Counter()).update(words)
+            self.class_words[label] += len(words)
+            self.vocab.update(words)
+        return self
+
+    def predict(self, data: Dict[str, Any]):
+        total = sum(self.class_docs.values())
+        if not total:
+            return None, 0.0
+        words = self.tokens(data)
+        vocab_size = len(self.vocab) + 1
+        scores = {}
+        for label, n_docs in self.class_docs.items():
+            counts, denom = self.word_counts[label], self.class_words[label] + vocab_size
+            scores[label] = math.log(n_docs / total) + sum(math.log((counts[w] + 1) / denom) for w in words)
+        best = max(scores, key=scores.get)
+        norm = sum(math.exp(v - scores[best]) for v in scores.values())
+        return best, 1.0 / norm
+
+_local_model = {"model": None, "reputation": {}, "trained_at": 0.0}
+_local_model_lock = threading.Lock()
+
+def load_labelled_logs(limit: int = 5000) -> List[Dict[str, Any]]:
+    # Only Gemini decisions are used as labels, so the local model never learns from itself.
+    return list(email_logs_collection.find(
+        {"ai_category": {"$ne": None}, "classified_by": {"$in": ["gemini", None]}},
+        {"from": 1, "subject": 1, "snippet": 1, "ai_category": 1, "triage_headers": 1, "message_id": 1}
+    ).sort("processed_at", -1).limit(limit))
+
+def build_sender_reputation(logs: List[Dict[str, Any]]) -> Dict[str, Counter]:
+    reputation: Dict[str, Counter] = {}
+    for log in logs:
+        reputation.setdefault(extract_email_address(log.get('from', '')).lower(), Counter())[log['ai_category']] += 1
+    return reputation
+
+def rebuild_sender_reputation():
+    # Seeds sender_reputation from email_logs history. New Gemini results keep it current.
+    reputation = build_sender_reputation(load_labelled_logs(limit=0))
+    sender_reputation_collection.delete_many({})
+    if reputation:
+        sender_reputation_collection.insert_many([
+            {"_id": sender, "categories": dict(counts), "total": sum(counts.values())}
+            for sender, counts in reputation.items()
+        ])
+    return len(reputation)
+
+def record_sender_reputation(emails: List[Dict[str, Any]], results: Dict[str, Dict[str, Any]]):
+    ops = [
+        UpdateOne(
+            {"_id": e['from_email'].lower()},
+            {"$inc": {f"categories.{results[e['id']].get('category')}": 1, "total": 1}},
+            upsert=True
+        )
+        for e in emails if e.get('from_email')
+    ]
+    if ops:
+        sender_reputation_collection.bulk_write(ops, ordered=False)
+
+def refresh_local_model(force: bool = False):
+    with _local_model_lock:
+        if not force and time.time() - _local_model["trained_at"] < LOCAL_MODEL_REFRESH:
+            return
+        logs = load_labelled_logs()
+        model = None
+        if PRECLASSIFY_MODEL and len(logs) >= LOCAL_MODEL_MIN_DOCS:
+            model = NaiveBayesClassifier().fit(logs, [log['ai_category'] for log in logs])
+        reputation = {
+            doc['_id']: Counter(doc.get('categories', {}))
+            for doc in sender_reputation_collection.find({"total": {"$gte": REPUTATION_MIN_COUNT}})
+        }
+        _local_model.update(model=model, reputation=reputation, trained_at=time.time())
+        print(f"Local pre-classifier refreshed: {len(logs)} labelled emails, {len(reputation)} known senders.")
+
+def preclassify(data: Dict[str, Any], model: NaiveBayesClassifier = None,
+                reputation: Dict[str, Counter] = None) -> Optional[Dict[str, Any]]:
+    # Decides obvious bulk/automated mail without the LLM. Only ever answers not_important
+    # (archive, no reply), and only when a strong signal is backed by at least one more;
+    # anything else returns None and goes to Gemini.
+    headers = data.get('triage_headers') or {}
+    sender = (data.get('from_email') or '').lower()
+    strong, weak = [], []
+    if headers.get('precedence', '').lower() in ('bulk', 'list', 'junk'):
+        strong.append(f"Precedence: {headers['precedence']}")
+    if headers.get('auto_submitted', 'no').lower() not in ('', 'no'):
+        strong.append(f"Auto-Submitted: {headers['auto_submitted']}")
+    counts = (reputation or {}).get(sender)
+    if counts and sum(counts.values()) >= REPUTATION_MIN_COUNT:
+        if counts['not_important'] / sum(counts.values()) >= PRECLASSIFY_THRESHOLD:
+            strong.append("sender reputation")
+    if headers.get('list_unsubscribe'):
+        weak.append("List-Unsubscribe header")
+    if _NO_REPLY_RE.match(sender):
+        weak.append("no-reply sender")
+
+    if not strong:
+        return None
+    if model is not None and model.predict(data)[0] == 'not_important':
+        weak.append("local model")
+    if len(strong) + len(weak) < 2:
+        return None
+    # Signals combine like a noisy-OR, so a strong signal plus any second one clears the default threshold.
+    confidence = 1 - (1 - STRONG_SIGNAL_WEIGHT) ** len(strong) * (1 - WEAK_SIGNAL_WEIGHT) ** len(weak)
+    if confidence < PRECLASSIFY_THRESHOLD:
+        return None
+    return {
+        "category": "not_important",
+        "confidence": round(confidence, 3),
+        "summary": f"Bulk or automated mail ({', '.join(strong + weak)})",
+        "action": "archive",
+        "reply_template": {"should_reply": False, "subject": None, "body": None},
+        "metadata": {"calendar_event": None}
+    }
+
+def evaluate_preclassifier(holdout_fraction: float = 0.2, limit: int = 5000) -> Dict[str, Any]:
+    # Replays Gemini-labelled history: trains on one part, triages the held-out part and
+    # reports how much mail the local stage would take and how often it agrees with Gemini,
+    # with the header/reputation rules alone and with the model added (PRECLASSIFY_MODEL).
+    logs = load_labelled_logs(limit=limit)
+    for log in logs:
+        log['from_email'] = extract_email_address(log.get('from', ''))
+    def held_out(log):
+        digest = hashlib.sha256(str(log.get('message_id')).encode()).digest()
+        return digest[0] / 256.0 < holdout_fraction
+    train = [log for log in logs if not held_out(log)]
+    test = [log for log in logs if held_out(log)]
+    model = NaiveBayesClassifier().fit(train, [log['ai_category'] for log in train]) if len(train) >= LOCAL_MODEL_MIN_DOCS else None
+    reputation = build_sender_reputation(train)
+    report = {"train": len(train), "held_out": len(test)}
+    for name, candidate_model in (("rules", None), ("rules_and_model", model)):
+        handled = agreed = 0
+        for log in test:
+            result = preclassify(log, model=candidate_model, reputation=reputation)
+            if result is not None:
+                handled += 1
+                agreed += result['category'] == log['ai_category']
+        report[name] = {
+            "handled": handled,
+            "handled_fraction": handled / len(test) if test else 0.0,
+            "agreement": agreed / handled if handled else None
+        }
+    return report
+
+def send_reply(service, reply_to: str, subject: str, body: str, thread_id: str=None, in_reply_to: str=None, sender_email: str=None,
+               message_id: str=None):
+    # Errors propagate so the outbox can retry the send.
     msg = MIMEText(body)
     if sender_email:
         msg['From'] = sender_email
     msg['To'] = reply_to
     msg['Subject'] = subject
+    if message_id:
+        msg['Message-ID'] = message_id
     if in_reply_to:
         msg['In-Reply-To'] = in_reply_to
         msg['References'] = in_reply_to
     
-    try:
-        raw = base64.urlsafe_b64encode(msg.as_bytes()).decode()
-        body_req = {'raw': raw}
-        if thread_id:
-            body_req['threadId'] = thread_id
-        
-        sent = service.users().messages().send(userId='me', body=body_req).execute()
-        return sent
-    except Exception as e:
-        print(f"Error sending reply: {e}")
-        return None
+    raw = base64.urlsafe_b64encode(msg.as_bytes()).decode()
+    body_req = {'raw': raw}
+    if thread_id:
+        body_req['threadId'] = thread_id
+    
+    return service.users().messages().send(userId='me', body=body_req).execute()
 
-def modify_labels(service, message_id: str, add_labels: List[str]=None, remove_labels: List[str]=None):
+def find_sent_message(service, message_id: str) -> bool:
+    resp = service.users().messages().list(userId='me', q=f"rfc822msgid:{message_id}", maxResults=1).execute()
+    return bool(resp.get('messages'))
+
+def batch_modify_labels(service, message_ids: List[str], add_labels: List[str]=None, remove_labels: List[str]=None):
+    # Errors propagate, HttpError included, so the outbox can tell permanent failures from retryable ones.
     body = {}
     if add_labels: body['addLabelIds'] = add_labels
     if remove_labels: body['removeLabelIds'] = remove_labels
-    try:
-        return service.users().messages().modify(userId='me', id=message_id, body=body).execute()
-    except Exception as e:
-        print(f"Error modifying labels for message {message_id}: {e}")
-        return None
+    # batchModify accepts up to 1000 ids per call.
+    for i in range(0, len(message_ids), 1000):
+        body['ids'] = message_ids[i:i + 1000]
+        with metrics.timed("gmail_modify"):
+            service.users().messages().batchModify(userId='me', body=body).execute()
+
+def modify_labels(service, message_id: str, add_labels: List[str]=None, remove_labels: List[str]=None):
+    return batch_modify_labels(service, [message_id], add_labels=add_labels, remove_labels=remove_labels)
 
 def shift_one_hour_earlier(iso_time: str) -> str:
     if not iso_time:
@@ -296,19 +1323,30 @@ def shift_one_hour_earlier(iso_time: str) -> str:
     except Exception as e:
         print(f"Error shifting time: {e}")
         return iso_time
-def create_calendar_event(creds, event_data: dict, attendee_email: str):
-    calendar_service = build('calendar', 'v3', credentials=creds)
-    
+def build_calendar_service(creds):
+    http = AuthorizedHttp(creds, http=httplib2.Http())
+    return build('calendar', 'v3', http=http, cache_discovery=False, static_discovery=True)
+
+def get_calendar_service(creds):
+    # Same per-thread caching as get_gmail_service: one discovery parse and HTTP client per thread.
+    services = getattr(_thread_local, 'calendar_services', None)
+    if services is None:
+        services = _thread_local.calendar_services = {}
+    if id(creds) not in services:
+        services[id(creds)] = build_calendar_service(creds)
+    return services[id(creds)]
+
+def build_prep_event(event_data: dict, attendee_email: str) -> Optional[Dict[str, Any]]:
     original_start = event_data.get('start')
     original_end = event_data.get('end')
     
     if not original_start or not original_end:
-        return False
+        return None
 
     new_start = shift_one_hour_earlier(original_start)
     new_end = shift_one_hour_earlier(original_end)
 
-    event = {
+    return {
         'summary': f"PREP: {event_data.get('summary', 'Interview/Meeting')}",
         'location': event_data.get('location', 'Online'),
         'description': f"[Preparation Block - 1 hour before actual event]\n"
@@ -329,107 +1367,1064 @@ def create_calendar_event(creds, event_data: dict, attendee_email: str):
         }
     }
 
+def calendar_fingerprint(user_email: str, event_data: dict, attendee_email: str) -> str:
+    # Follow-ups about the same interview extract the same event, give or take wording and
+    # timestamp formatting, so the key is the normalized summary, the UTC start and the attendee.
+    start = event_data.get('start') or ''
     try:
-        created_event = calendar_service.events().insert(calendarId='primary', body=event).execute()
-        print(f"PREP EVENT CREATED (1 hour before): {created_event.get('htmlLink')}")
-        return True
-    except Exception as e:
-        print(f"Failed to create calendar event: {e}")
-        return False
+        dt = datetime.fromisoformat(start.replace("Z", "+00:00"))
+        if dt.tzinfo is None:
+            dt = pytz.timezone("Asia/Kolkata").localize(dt)
+        start = dt.astimezone(pytz.utc).isoformat()
+    except ValueError:
+        pass
+    key = "|".join([user_email, normalize_text(event_data.get('summary', '')), start, (attendee_email or '').lower()])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def create_calendar_events(account: Account, requests: List[tuple]) -> Dict[str, Any]:
+    # Creates or updates PREP events for (key, event_data, attendee_email) tuples with one Calendar
+    # batch request. Returns {key: event, None when event_data has no times, or the exception}.
+    # An event already recorded under the same fingerprint is patched instead of duplicated; the
+    # event id is derived from the fingerprint, so a concurrent or retried insert gets a 409.
+    # Calendar keeps a deleted event's id reserved (the insert 409s) and a patch alone leaves it
+    # cancelled, so patches also set it confirmed again.
+    service = get_calendar_service(account.creds)
+    results = {}
+    by_fingerprint: Dict[str, List[str]] = {}
+    bodies = {}
+    for key, event_data, attendee_email in requests:
+        body = build_prep_event(event_data, attendee_email)
+        if body is None:
+            results[key] = None
+            continue
+        fingerprint = calendar_fingerprint(account.user_email, event_data, attendee_email)
+        by_fingerprint.setdefault(fingerprint, []).append(key)
+        bodies[fingerprint] = body
+    if not bodies:
+        return results
+
+    known = {doc["_id"]: doc for doc in calendar_events_collection.find({"_id": {"$in": list(bodies)}})}
+    responses = {}
+    def on_response(request_id, response, exception):
+        responses[request_id] = exception if exception is not None else response
+
+    batch = service.new_batch_http_request(callback=on_response)
+    for fingerprint, body in bodies.items():
+        if fingerprint in known:
+            batch.add(service.events().patch(calendarId='primary', eventId=known[fingerprint]["event_id"],
+                                             body=dict(body, status='confirmed')),
+                      request_id=fingerprint)
+        else:
+            batch.add(service.events().insert(calendarId='primary', body=dict(body, id=idempotency_token(fingerprint))),
+                      request_id=fingerprint)
+    with metrics.timed("calendar_batch"):
+        batch.execute()
+
+    records = []
+    for fingerprint, body in bodies.items():
+        event = responses.get(fingerprint)
+        if isinstance(event, HttpError) and event.resp.status == 409:
+            try:
+                event = service.events().patch(calendarId='primary', eventId=idempotency_token(fingerprint),
+                                               body=dict(body, status='confirmed')).execute()
+            except Exception as e:
+                event = e
+        if isinstance(event, dict):
+            updated = fingerprint in known or responses.get(fingerprint) is not event
+            bump_stat("calendar_events_updated" if updated else "calendar_events_created")
+            print(f"PREP EVENT {'UPDATED' if updated else 'CREATED'} (1 hour before): {event.get('htmlLink')}")
+            records.append(UpdateOne(
+                {"_id": fingerprint},
+                {"$set": {"account": account.user_email, "event_id": event.get("id"),
+                          "html_link": event.get("htmlLink"), "updated_at": int(time.time())}},
+                upsert=True
+            ))
+        elif event is None:
+            event = RuntimeError("No response for calendar request")
+        for key in by_fingerprint[fingerprint]:
+            results[key] = event
+    if records:
+        calendar_events_collection.bulk_write(records, ordered=False)
+    return results
+
+def full_sync(service, query: str = INBOX_QUERY):
+    # Read the history id before listing so nothing that arrives in between is skipped.
+    # Later cycles only see deltas, so every current match has to be listed here, not just the first page.
+    # Returns (messages, history_id); the caller saves the id once the messages are stored.
+    profile = service.users().getProfile(userId='me').execute()
+    msgs = []
+    page_token = None
+    while True:
+        kwargs = {'userId': 'me', 'q': query, 'maxResults': 100}
+        if page_token:
+            kwargs['pageToken'] = page_token
+        messages_resp = service.users().messages().list(**kwargs).execute()
+        msgs.extend(messages_resp.get('messages', []) or [])
+        page_token = messages_resp.get('nextPageToken')
+        if not page_token:
+            break
+    return msgs, profile['historyId']
+
+def incremental_sync(service, start_history_id: str):
+    msgs = []
+    seen = set()
+    page_token = None
+    latest_history_id = start_history_id
+    while True:
+        kwargs = {
+            'userId': 'me',
+            'startHistoryId': start_history_id,
+            'historyTypes': ['messageAdded', 'labelAdded']
+        }
+        if page_token:
+            kwargs['pageToken'] = page_token
+        resp = service.users().history().list(**kwargs).execute()
+        for record in resp.get('history', []) or []:
+            entries = (record.get('messagesAdded', []) or []) + (record.get('labelsAdded', []) or [])
+            for entry in entries:
+                message = entry.get('message', {})
+                msg_id = message.get('id')
+                if not msg_id or msg_id in seen:
+                    continue
+                if not INBOX_LABELS.issubset(message.get('labelIds', []) or []):
+                    continue
+                seen.add(msg_id)
+                msgs.append({'id': msg_id, 'threadId': message.get('threadId')})
+        latest_history_id = resp.get('historyId', latest_history_id)
+        page_token = resp.get('nextPageToken')
+        if not page_token:
+            break
+    return msgs, latest_history_id
 
-def main_loop(poll_interval=20):
+def sync_new_messages(service, user_email: str, incremental: bool = True):
+    # Returns (messages, history_id). The new history id is not saved here: if the messages were
+    # lost before reaching processed_messages, a saved id would skip them for good.
+    if not incremental:
+        messages_resp = service.users().messages().list(userId='me', q=INBOX_QUERY, maxResults=20).execute()
+        return messages_resp.get('messages', []) or [], None
+
+    history_id = get_history_id(user_email)
+    if not history_id:
+        print("No stored history id. Running full sync.")
+        return full_sync(service)
     try:
-        service, creds, user_email = gmail_authenticate()
-        print("Authenticated with Gmail.")
+        return incremental_sync(service, history_id)
+    except HttpError as e:
+        if e.resp.status == 404:
+            print("Stored history id has expired. Falling back to full sync.")
+            return full_sync(service)
+        raise
+
+def triage_messages(batch: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    # Runs the local pre-classifier on metadata-only records; returns results for the ones it decided.
+    results = {}
+    if not PRECLASSIFY_ENABLED:
+        return results
+    refresh_local_model()
+    for data in batch:
+        local = preclassify(data, model=_local_model["model"], reputation=_local_model["reputation"])
+        if local is not None:
+            metrics.log_event("preclassified", data.get('trace_id'), message_id=data['id'],
+                              category=local.get('category'), summary=local.get('summary'))
+            local["classified_by"] = "local"
+            results[data['id']] = local
+            bump_stat("preclassify_handled")
+        else:
+            bump_stat("preclassify_deferred")
+    return results
+
+def classify_messages(batch: List[Dict[str, Any]], dry_run: bool = False) -> List[Dict[str, Any]]:
+    # Dry runs read the cache but write neither cache entries nor sender reputation, which
+    # drives live archiving; the real run over the same mail records them once.
+    for data in batch:
+        metrics.log_event("email_received", data.get('trace_id'), message_id=data['id'], account=data.get('account'),
+                          sender=data['from'], subject=data['subject'])
+
+    results = {}
+    for data in batch:
+        cached = lookup_cached_classification(data)
+        if cached is not None:
+            metrics.log_event("classification_cached", data.get('trace_id'), message_id=data['id'])
+            cached["classified_by"] = "cache"
+            results[data['id']] = cached
+
+    misses = [data for data in batch if data['id'] not in results]
+    if misses:
+        fresh = call_gemini_for_structured_batch(misses)
+        for data in misses:
+            if not dry_run:
+                store_cached_classification(data, fresh[data['id']])
+            fresh[data['id']]["classified_by"] = "gemini"
+        if not dry_run:
+            record_sender_reputation(misses, fresh)
+        results.update(fresh)
+
+    for data in batch:
+        structured = results[data['id']]
+        metrics.log_event("classified", data.get('trace_id'), message_id=data['id'], category=structured.get('category'),
+                          action=structured.get('action'), classified_by=structured.get('classified_by'))
+    return [results[data['id']] for data in batch]
+
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "5"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "600"))
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "120"))
+OUTBOX_POLL_INTERVAL = 2
+# Set when new actions are written, so idle drain workers start without waiting for their next poll.
+outbox_wakeup = threading.Event()
+
+def outbox_action(account: Account, data: Dict[str, Any], action_type: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    # The _id is the idempotency key: one action of each type per message, however often it is planned.
+    now = int(time.time())
+    return {
+        "_id": f"{data['id']}:{action_type}",
+        "type": action_type,
+        "account": account.user_email,
+        "message_id": data['id'],
+        "trace_id": data.get('trace_id'),
+        "payload": payload,
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": now,
+        "created_at": now
+    }
+
+def idempotency_token(key: str) -> str:
+    # Lowercase hex is valid both in a Message-ID and as a Calendar event id (base32hex).
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def plan_actions(account: Account, data: Dict[str, Any], structured: Dict[str, Any]):
+    # Decides the reply/calendar/label side effects for one classified message without running them.
+    # Returns the reply template, the action status and the outbox actions; the outbox drain
+    # workers carry them out once the message has been saved.
+    reply_template = structured.get('reply_template', {}) or {}
+    actions = []
+    action_status = ""
+    if reply_template.get('should_reply'):
+        domain = account.user_email.partition('@')[2] or "localhost"
+        actions.append(outbox_action(account, data, "reply", {
+            "to": data['from_email'],
+            "subject": reply_template.get('subject') or f"Re: {data['subject']}",
+            "body": reply_template.get('body') or "Thank you for your email. I have received it and will get back to you shortly.",
+            "thread_id": data.get('thread_id'),
+            "in_reply_to": data.get('message_id_header'),
+            "sender": account.user_email,
+            "rfc822_message_id": f"<{idempotency_token(data['id'] + ':reply')}@{domain}>"
+        }))
+        action_status = "Automated reply queued."
+
+    if structured.get('action') == 'archive' or structured.get('category') == 'not_important':
+        remove_labels = ['UNREAD', 'INBOX']
+        action_status += " Email processed and archived."
+    else:
+        remove_labels = ['UNREAD']
+        action_status += " Email processed, marked as read."
+    actions.append(outbox_action(account, data, "labels", {"remove_labels": remove_labels}))
+
+    event_data = structured.get('metadata', {}).get('calendar_event')
+    if event_data and event_data.get('start') and event_data.get('end'):
+        actions.append(outbox_action(account, data, "calendar", {
+            "event": event_data,
+            "attendee": data['from_email']
+        }))
+        action_status += " Calendar PREP event queued."
+
+    metrics.log_event("actions_planned", data.get('trace_id'), message_id=data['id'],
+                      actions=",".join(action["type"] for action in actions),
+                      reply_subject=actions[0]["payload"]["subject"] if actions[0]["type"] == "reply" else None)
+    return reply_template, action_status.strip(), actions
+
+def enqueue_actions(actions: List[Dict[str, Any]]):
+    bulk_write_ignoring_duplicates(outbox_collection, [
+        UpdateOne({"_id": action["_id"]}, {"$setOnInsert": action}, upsert=True) for action in actions
+    ])
+    if actions:
+        outbox_wakeup.set()
+
+def claim_actions(accounts: List[str], limit: int = GMAIL_BATCH_SIZE) -> List[Dict[str, Any]]:
+    # Claims the next due action under a lease, as claim_messages does for messages. Label changes
+    # with the same labels on the same mailbox are claimed together so they share one batchModify,
+    # and calendar events for the same mailbox so they share one Calendar batch request.
+    def claim(extra: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        now = int(time.time())
+        query = {"account": {"$in": accounts}, "$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"status": "in_progress", "lease_expires_at": {"$lt": now}}
+        ]}
+        query.update(extra)
+        return outbox_collection.find_one_and_update(
+            query,
+            {"$set": {"status": "in_progress", "owner": WORKER_ID, "lease_expires_at": now + OUTBOX_LEASE_SECONDS},
+             "$inc": {"attempts": 1}},
+            sort=[("next_attempt_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    if not accounts:
+        return []
+    first = claim({})
+    if first is None:
+        return []
+    actions = [first]
+    group = {"type": first["type"], "account": first["account"]}
+    if first["type"] == "labels":
+        group["payload.remove_labels"] = first["payload"]["remove_labels"]
+    if first["type"] in ("labels", "calendar"):
+        while len(actions) < limit:
+            action = claim(group)
+            if action is None:
+                break
+            actions.append(action)
+    return actions
+
+def complete_action(action: Dict[str, Any], log_fields: Dict[str, Any] = None):
+    outbox_collection.update_one(
+        {"_id": action["_id"], "owner": WORKER_ID},
+        {"$set": {"status": "done", "completed_at": int(time.time())}, "$unset": {"lease_expires_at": ""}}
+    )
+    fields = {f"actions.{action['type']}": "done"}
+    fields.update(log_fields or {})
+    email_logs_collection.update_one({"message_id": action["message_id"]}, {"$set": fields})
+    bump_stat(f"outbox_{action['type']}_done")
+
+def fail_action(action: Dict[str, Any], error: Exception):
+    # Retries with full-jitter exponential backoff; requests Google rejected outright, and
+    # actions out of attempts, become dead letters for --dead-letters to report.
+    metrics.count_error("calendar" if action["type"] == "calendar" else "gmail", error)
+    permanent = isinstance(error, HttpError) and error.resp.status in (400, 404)
+    if permanent or action["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+        metrics.log_event("action_dead", action.get("trace_id"), action=action["_id"], attempts=action["attempts"],
+                          error=str(error))
+        bump_stat("outbox_dead_letters")
+        update = {"$set": {"status": "dead", "last_error": str(error)}, "$unset": {"lease_expires_at": ""}}
+        email_logs_collection.update_one({"message_id": action["message_id"]}, {"$set": {f"actions.{action['type']}": "dead"}})
+    else:
+        delay = random.uniform(0, min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * (2 ** (action["attempts"] - 1))))
+        metrics.log_event("action_retry", action.get("trace_id"), action=action["_id"], attempts=action["attempts"],
+                          retry_in=round(delay), error=str(error))
+        bump_stat("outbox_retries")
+        update = {"$set": {"status": "pending", "last_error": str(error), "next_attempt_at": int(time.time() + delay)},
+                  "$unset": {"lease_expires_at": ""}}
+    outbox_collection.update_one({"_id": action["_id"], "owner": WORKER_ID}, update)
+
+def execute_actions(account: Account, actions: List[Dict[str, Any]]):
+    first = actions[0]
+    if first["type"] == "labels":
+        service = get_gmail_service(account.creds)
+        remove_labels = first["payload"]["remove_labels"]
+        try:
+            batch_modify_labels(service, [a["message_id"] for a in actions], remove_labels=remove_labels)
+        except Exception as e:
+            if len(actions) == 1:
+                raise
+            # One bad id fails the whole call. Retry one by one so only the actions that really
+            # fail spend an attempt, each with its own error.
+            print(f"batchModify for {len(actions)} messages failed ({e}). Retrying them one at a time.")
+            for action in actions:
+                try:
+                    batch_modify_labels(service, [action["message_id"]], remove_labels=remove_labels)
+                except Exception as e:
+                    fail_action(action, e)
+                else:
+                    complete_action(action)
+            return
+        for action in actions:
+            complete_action(action)
+    elif first["type"] == "reply":
+        service = get_gmail_service(account.creds)
+        payload = first["payload"]
+        # A previous attempt may have sent the reply and died before recording it.
+        if first["attempts"] > 1 and find_sent_message(service, payload["rfc822_message_id"]):
+            metrics.log_event("reply_already_sent", first.get("trace_id"), message_id=first["message_id"])
+        else:
+            with metrics.timed("gmail_send"):
+                send_reply(service, payload["to"], payload["subject"], payload["body"], thread_id=payload.get("thread_id"),
+                           in_reply_to=payload.get("in_reply_to"), sender_email=payload["sender"],
+                           message_id=payload["rfc822_message_id"])
+            metrics.log_event("reply_sent", first.get("trace_id"), message_id=first["message_id"])
+        complete_action(first)
+    elif first["type"] == "calendar":
+        results = create_calendar_events(account, [
+            (action["_id"], action["payload"]["event"], action["payload"]["attendee"]) for action in actions
+        ])
+        for action in actions:
+            event = results[action["_id"]]
+            if isinstance(event, Exception):
+                fail_action(action, event)
+            else:
+                complete_action(action, {"calendar_link": event.get("htmlLink")} if event else None)
+    else:
+        raise ValueError(f"Unknown outbox action type {first['type']}")
+
+class OutboxDrainer:
+    """Worker threads that carry out the actions in the outbox collection.
+
+    Replies, label changes and calendar events are written to the outbox, keyed by message
+    and action type, in the same persist step that marks a message processed. These workers
+    claim due actions under a lease, run them and retry failures with backoff, so a slow or
+    failing Google call never holds up classification. An action whose owner died is
+    reclaimed when its lease expires; replies carry a deterministic Message-ID and calendar
+    events an id derived from their fingerprint, so such a retry never sends or creates
+    anything twice.
+    """
+
+    def __init__(self, accounts: Dict[str, Account], workers: int = OUTBOX_WORKERS):
+        self.accounts = accounts
+        self.workers = workers
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"outbox-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        self.stopping.set()
+        outbox_wakeup.set()
+        for t in self.threads:
+            t.join()
+
+    def _worker(self):
+        while not self.stopping.is_set():
+            try:
+                with metrics.timed("outbox_claim"):
+                    actions = claim_actions(list(self.accounts))
+            except Exception as e:
+                metrics.count_error("mongo", e)
+                print(f"Error claiming outbox actions: {e}")
+                actions = []
+            if not actions:
+                outbox_wakeup.wait(OUTBOX_POLL_INTERVAL)
+                outbox_wakeup.clear()
+                continue
+            try:
+                execute_actions(self.accounts[actions[0]["account"]], actions)
+            except Exception as e:
+                try:
+                    for action in actions:
+                        fail_action(action, e)
+                except Exception as e:
+                    print(f"Error recording failed outbox actions: {e}")
+
+def dead_letters(limit: int = 100) -> List[Dict[str, Any]]:
+    return list(outbox_collection.find({"status": "dead"}).sort("created_at", DESCENDING).limit(limit))
+
+def retry_dead_letters() -> int:
+    result = outbox_collection.update_many(
+        {"status": "dead"},
+        {"$set": {"status": "pending", "attempts": 0, "next_attempt_at": int(time.time())}}
+    )
+    return result.modified_count
+
+def failed_messages(limit: int = 100) -> List[Dict[str, Any]]:
+    return list(processed_collection.find({"status": "failed"}).sort("processed_at", DESCENDING).limit(limit))
+
+def retry_failed_messages() -> int:
+    # Failed messages count as processed, so syncs skip them; this puts them back in the queue.
+    result = processed_collection.update_many(
+        {"status": "failed"},
+        {"$set": {"status": "pending", "attempts": 0},
+         "$unset": {"owner": "", "processed_at": "", "next_attempt_at": ""}}
+    )
+    return result.modified_count
 
+CLASSIFY_WORKERS = int(os.getenv("CLASSIFY_WORKERS", "4"))
+ACT_WORKERS = int(os.getenv("ACT_WORKERS", "4"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "20"))
+PIPELINE_MAX_ATTEMPTS = int(os.getenv("PIPELINE_MAX_ATTEMPTS", "5"))
+
+def drain_queue(q: queue.Queue, first, limit: int) -> list:
+    # Returns `first` plus whatever else is already waiting, up to `limit` items.
+    # Stops early at a None sentinel, which is kept as the last element.
+    items = [first]
+    while items[-1] is not None and len(items) < limit:
+        try:
+            items.append(q.get_nowait())
+        except queue.Empty:
+            break
+    return items
+
+class MessagePipeline:
+    """Staged fetch -> classify -> act -> persist engine.
+
+    Fetching runs on the submitting thread with one Gmail batch per call. Classify and act
+    each have a pool of worker threads, persist has a single one. Stages are connected by
+    bounded queues, so a slow stage blocks the one in front of it instead of piling up
+    messages in memory. The act stage only plans the reply, label and calendar actions;
+    persist writes them to the outbox together with the log, and OutboxDrainer runs them.
+
+    Every queued item carries the Account it belongs to, so one pipeline (and one set of
+    workers, Mongo pool and Gemini budget) serves any number of mailboxes.
+
+    Messages are submitted already claimed (see claim_messages). The act stage renews the
+    lease before planning its actions and drops the message if another worker has taken it over.
+
+    With dry_run=True nothing is claimed or changed: classifications and the planned actions
+    go to the dry_run_logs collection instead of email_logs and the outbox.
+    """
+
+    def __init__(self, classify_workers: int = CLASSIFY_WORKERS, act_workers: int = ACT_WORKERS,
+                 queue_size: int = PIPELINE_QUEUE_SIZE, classify_batch_size: int = GEMINI_BATCH_SIZE,
+                 dry_run: bool = False):
+        self.classify_batch_size = max(1, classify_batch_size)
+        self.dry_run = dry_run
+        self.workers = [
+            (self._classify_worker, classify_workers),
+            (self._act_worker, act_workers),
+            (self._persist_worker, 1)
+        ]
+        self.classify_queue = queue.Queue(maxsize=queue_size)
+        self.act_queue = queue.Queue(maxsize=queue_size)
+        self.persist_queue = queue.Queue(maxsize=queue_size)
+        metrics.register_queue("classify", self.classify_queue)
+        metrics.register_queue("act", self.act_queue)
+        metrics.register_queue("persist", self.persist_queue)
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self):
+        for target, count in self.workers:
+            for i in range(count):
+                t = threading.Thread(target=target, name=f"{target.__name__.strip('_')}-{i}", daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def submit(self, account: Account, msgs: List[Dict[str, Any]]) -> int:
+        with self.lock:
+            fresh = []
+            for m in msgs:
+                if m['id'] not in self.in_flight:
+                    self.in_flight.add(m['id'])
+                    fresh.append(m)
+            msgs = fresh
+        if not msgs:
+            return 0
+
+        # Phase 1: headers and snippet only, enough for local triage.
+        service = get_gmail_service(account.creds)
+        start_bytes = thread_bytes_received()
+        with metrics.timed("gmail_fetch_metadata"):
+            records = get_messages_batch(service, msgs, fmt='metadata')
+        bump_stat("gmail_metadata_bytes", thread_bytes_received() - start_bytes)
+        records = self._drop_fetch_failures(records)
+        for data in records:
+            data['account'] = account.user_email
+            # Follows the message through the logs, its email_logs entry and its outbox actions.
+            data['trace_id'] = metrics.new_trace_id()
+        with metrics.timed("triage"):
+            local = triage_messages(records)
+        for data in records:
+            if data['id'] in local:
+                self.act_queue.put((account, data, local[data['id']]))
+
+        # Phase 2: full MIME payload for the messages that still need the model.
+        needs_body = [data for data in records if data['id'] not in local]
+        start_bytes = thread_bytes_received()
+        with metrics.timed("gmail_fetch_body"):
+            fetch_bodies(service, needs_body)
+        full_bytes = thread_bytes_received() - start_bytes
+        bump_stat("gmail_full_bytes", full_bytes)
+        needs_body = self._drop_fetch_failures(needs_body)
+        # Per-cycle gauges: what this fetch downloaded and kept, and resident memory once it is held.
+        set_stat("cycle_full_bytes", full_bytes)
+        set_stat("cycle_body_bytes", sum(len(data['body']) for data in needs_body))
+        rss_kb = current_rss_kb()
+        if rss_kb is not None:
+            set_stat("cycle_rss_kb", rss_kb)
+        for data in needs_body:
+            self.classify_queue.put((account, data))
+        return len(msgs)
+
+    def join(self):
+        self.classify_queue.join()
+        self.act_queue.join()
+        self.persist_queue.join()
+
+    def stop(self):
+        self.join()
+        for q, (_, count) in zip((self.classify_queue, self.act_queue, self.persist_queue), self.workers):
+            for _ in range(count):
+                q.put(None)
+        for t in self.threads:
+            t.join()
+
+    def _release(self, msg_id: str):
+        with self.lock:
+            self.in_flight.discard(msg_id)
+
+    def _drop_fetch_failures(self, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # A message Gmail did not return is put back for a later claim, never classified blank.
+        ok = []
+        for data in records:
+            if data.get('fetch_error'):
+                bump_stat("gmail_fetch_failures")
+                metrics.log_event("fetch_failed", data.get('trace_id'), message_id=data['id'], error=data['fetch_error'])
+                self._fail(data)
+            else:
+                ok.append(data)
+        return ok
+
+    def _fail(self, data: Dict[str, Any]):
+        # The claim goes back to the shared queue, so any worker can pick up the retry.
+        self._release(data['id'])
+        if self.dry_run:
+            print(f"Dry run: skipping message {data['id']} after an error.")
+            return
+        try:
+            if not release_claim(data['id'], PIPELINE_MAX_ATTEMPTS):
+                metrics.log_event("message_failed", data.get('trace_id'), message_id=data['id'], attempts=PIPELINE_MAX_ATTEMPTS)
+        except Exception as e:
+            print(f"Error releasing message {data['id']}: {e}")
+
+    def _classify_worker(self):
         while True:
+            batch = drain_queue(self.classify_queue, self.classify_queue.get(), self.classify_batch_size)
+            stop = batch[-1] is None
+            batch = [item for item in batch if item is not None]
             try:
-                query = "is:unread is:important"
-                messages_resp = service.users().messages().list(userId='me', q=query, maxResults=20).execute()
-                msgs = messages_resp.get('messages', []) or []
+                if batch:
+                    try:
+                        with metrics.timed("classify"):
+                            results = classify_messages([data for _, data in batch], dry_run=self.dry_run)
+                    except Exception as e:
+                        metrics.count_error("classify", e)
+                        for _, data in batch:
+                            metrics.log_event("classify_failed", data.get('trace_id'), message_id=data['id'], error=str(e))
+                            self._fail(data)
+                    else:
+                        for (account, data), structured in zip(batch, results):
+                            self.act_queue.put((account, data, structured))
+            finally:
+                for _ in range(len(batch) + (1 if stop else 0)):
+                    self.classify_queue.task_done()
+            if stop:
+                return
 
-                if not msgs:
-                    print(f"No new important unread emails. Sleeping for {poll_interval}s...")
-                    time.sleep(poll_interval)
+    def _act_worker(self):
+        while True:
+            item = self.act_queue.get()
+            try:
+                if item is None:
+                    return
+                account, data, structured = item
+                try:
+                    if not self.dry_run and not renew_lease(data['id']):
+                        metrics.log_event("lease_lost", data.get('trace_id'), message_id=data['id'])
+                        self._release(data['id'])
+                        continue
+                    with metrics.timed("plan_actions"):
+                        result = plan_actions(account, data, structured)
+                except Exception as e:
+                    metrics.count_error("plan", e)
+                    metrics.log_event("plan_failed", data.get('trace_id'), message_id=data['id'], error=str(e))
+                    self._fail(data)
                     continue
+                self.persist_queue.put((account, data, structured) + result)
+            finally:
+                self.act_queue.task_done()
 
-                for msg in msgs:
-                    msg_id = msg['id']
-                    if is_processed(msg_id):
-                        continue
+    def _persist_worker(self):
+        while True:
+            # Take whatever else is already waiting so a burst shares one bulk write per collection.
+            items = drain_queue(self.persist_queue, self.persist_queue.get(), GMAIL_BATCH_SIZE)
+            stop = items[-1] is None
+            items = [item for item in items if item is not None]
+            try:
+                try:
+                    results = [
+                        (data, reply_template, action_status, structured)
+                        for _, data, structured, reply_template, action_status, _ in items
+                    ]
+                    actions = [action for item in items for action in item[5]]
+                    with metrics.timed("mongo_persist"):
+                        if self.dry_run:
+                            persist_dry_run(results, actions)
+                        else:
+                            persist_results(results, actions=actions)
+                except Exception as e:
+                    metrics.count_error("mongo", e)
+                    print(f"Error saving messages {[item[1]['id'] for item in items]}: {e}")
+            finally:
+                for _, data, _, _, _, _ in items:
+                    self._release(data['id'])
+                for _ in range(len(items) + (1 if stop else 0)):
+                    self.persist_queue.task_done()
+            if stop:
+                return
 
-                    data = get_message_snippet_and_body(service, msg)
-                    print("-" * 50)
-                    print(f"Processing NEW EMAIL:")
-                    print(f"From: {data['from']}")
-                    print(f"Subject: {data['subject']}")
-                    print("-" * 50)
-
-                    structured = call_gemini_for_structured(data['subject'], data['from'], data['body'])
-                    print("Model classified as:", structured.get('category'), "action:", structured.get('action'))
-                    
-                    reply_template = structured.get('reply_template', {}) or {}
-                    if reply_template.get('should_reply'):
-                        print("\nAI Proposed Reply:")
-                        print(f"Subject: {reply_template.get('subject')}")
-                        print(f"Body:\n{reply_template.get('body')}")
-                        print("-" * 50)
-                    else:
-                        print("\nReply: None")
-                        print("-" * 50)
-
-                    event_data = structured.get('metadata', {}).get('calendar_event')
-                    calendar_created = False
-                    if event_data and event_data.get('start') and event_data.get('end'):
-                        calendar_created = create_calendar_event(creds, event_data, data['from_email'])
-
-                    action_status = ""
-                    if reply_template.get('should_reply'):
-                        subject_reply = reply_template.get('subject') or f"Re: {data['subject']}"
-                        body_reply = reply_template.get('body') or "Thank you for your email. I have received it and will get back to you shortly."
-                        full_meta = service.users().messages().get(userId='me', id=msg_id, format='metadata').execute()
-                        thread_id = full_meta.get('threadId')
-                        try:
-                            send_reply(
-                                service,
-                                data['from_email'],
-                                subject_reply,
-                                body_reply,
-                                thread_id=thread_id,
-                                in_reply_to=data.get('message_id_header'),
-                                sender_email=user_email
-                            )
-                            print("Sent automated reply.")
-                            action_status = "Sent automated reply."
-                        except Exception as e:
-                            print(f"Failed to send reply: {e}")
-                            action_status = f"Failed to send reply: {e}"
-
-                    if structured.get('action') == 'archive' or structured.get('category') == 'not_important':
-                        modify_labels(service, msg_id, remove_labels=['UNREAD', 'INBOX'])
-                        action_status += " Email processed and archived."
-                        print("Email processed and archived.")
-                    else:
-                        modify_labels(service, msg_id, remove_labels=['UNREAD'])
-                        action_status += " Email processed, marked as read."
-                        print("Email processed, marked as read.")
+ACCOUNT_MIN_INTERVAL = float(os.getenv("ACCOUNT_MIN_INTERVAL", "5"))
+ACCOUNT_MAX_INTERVAL = float(os.getenv("ACCOUNT_MAX_INTERVAL", "300"))
+ACCOUNT_CLAIM_LIMIT = int(os.getenv("ACCOUNT_CLAIM_LIMIT", str(CLAIM_BATCH_SIZE)))
+ACCOUNT_REFRESH_SECONDS = int(os.getenv("ACCOUNT_REFRESH_SECONDS", "60"))
+
+class AccountScheduler:
+    """Decides which mailbox to poll next in multi-account mode.
+
+    Accounts sit in a heap ordered by their next poll time. A poll that found mail halves the
+    account's interval (down to min_interval) and a quiet one doubles it (up to max_interval).
+    Each poll claims at most ACCOUNT_CLAIM_LIMIT messages; an account with more waiting is due
+    again at once but queues behind every account that was already due, so a flooded inbox
+    gets its share in turns instead of starving the others.
+
+    Only the newest heap entry of an account is live: each push bumps the account's generation,
+    and older entries (say, from before it was disabled and enabled again) are skipped.
+    """
+
+    def __init__(self, min_interval: float = ACCOUNT_MIN_INTERVAL, max_interval: float = ACCOUNT_MAX_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.accounts: Dict[str, Account] = {}
+        self.intervals: Dict[str, float] = {}
+        self.generations: Dict[str, int] = {}
+        self.heap = []
+
+    def _push(self, user_email: str, due: float):
+        generation = self.generations.get(user_email, 0) + 1
+        self.generations[user_email] = generation
+        heapq.heappush(self.heap, (due, user_email, generation))
+
+    def refresh(self):
+        # Picks up accounts added or disabled since the last call. Existing Account objects are
+        # kept so their per-thread Gmail services stay cached.
+        enabled = set()
+        for doc in accounts_collection.find({"enabled": {"$ne": False}}):
+            enabled.add(doc["_id"])
+            if doc["_id"] in self.accounts:
+                continue
+            try:
+                self.accounts[doc["_id"]] = load_account(doc)
+            except Exception as e:
+                print(f"Could not load credentials for {doc['_id']}: {e}")
+                continue
+            self.intervals[doc["_id"]] = self.min_interval
+            self._push(doc["_id"], time.time())
+            print(f"Serving mailbox {doc['_id']}.")
+        for user_email in set(self.accounts) - enabled:
+            print(f"Stopped serving mailbox {user_email}.")
+            del self.accounts[user_email]
+            del self.intervals[user_email]
+
+    def next_due(self):
+        # Returns (account, 0) for the next account to poll, or (None, seconds until one is due).
+        while self.heap:
+            due, user_email, generation = self.heap[0]
+            if user_email not in self.accounts or generation != self.generations.get(user_email):
+                heapq.heappop(self.heap)
+                continue
+            wait = due - time.time()
+            if wait > 0:
+                return None, wait
+            heapq.heappop(self.heap)
+            return self.accounts[user_email], 0
+        return None, self.max_interval
+
+    def reschedule(self, account: Account, claimed: int, limit: int = ACCOUNT_CLAIM_LIMIT):
+        if account.user_email not in self.accounts:
+            return
+        interval = self.intervals[account.user_email]
+        if claimed:
+            interval = max(self.min_interval, interval / 2)
+        else:
+            interval = min(self.max_interval, interval * 2)
+        self.intervals[account.user_email] = interval
+        self._push(account.user_email, time.time() + (0 if claimed >= limit else interval))
 
-                    if calendar_created:
-                        action_status += " Calendar PREP event created 1 hour early."
+def poll_account(pipeline: MessagePipeline, account: Account, limit: int = CLAIM_BATCH_SIZE,
+                 incremental: bool = True) -> int:
+    # One turn for a mailbox. Everything listed goes into the shared queue; this worker then
+    # claims its share, including messages whose previous owner died holding the lease.
+    service = get_gmail_service(account.creds)
+    with metrics.timed("gmail_sync"):
+        msgs, history_id = sync_new_messages(service, account.user_email, incremental=incremental)
+    with metrics.timed("mongo_claim"):
+        enqueue_messages(account.user_email, msgs)
+        # Only now are the listed messages durable, so the next delta can start after them.
+        if history_id:
+            save_history_id(account.user_email, history_id)
+        msgs = claim_messages(account.user_email, limit)
+    # submit() blocks while the pipeline is saturated, which throttles polling.
+    if msgs:
+        pipeline.submit(account, msgs)
+    return len(msgs)
 
-                    store_email_and_reply(data, reply_template, action_status)
-                    mark_processed(msg_id)
-                    time.sleep(2)
+STARTUP_TARGET_SECONDS = float(os.getenv("STARTUP_TARGET_SECONDS", "5"))
+
+def record_first_poll():
+    # Cold start is measured from the first line of this module to the end of the first poll.
+    if "startup_first_poll_seconds" in get_stats():
+        return
+    elapsed = round(time.perf_counter() - _IMPORT_STARTED, 3)
+    set_stat("startup_first_poll_seconds", elapsed)
+    verdict = "within" if elapsed <= STARTUP_TARGET_SECONDS else "over"
+    print(f"Startup: import {get_stats().get('startup_import_seconds')}s, first poll {elapsed}s "
+          f"({verdict} the {STARTUP_TARGET_SECONDS}s target).")
+
+def main_loop(poll_interval=20, incremental=True, interactive=True):
+    try:
+        service, creds, user_email = gmail_authenticate(interactive)
+        print("Authenticated with Gmail.")
+        ensure_indexes()
+        ensure_stats()
+        metrics.start_metrics_server(get_stats, _gauge_stats)
+        account = Account(user_email, creds)
+        pipeline = MessagePipeline()
+        pipeline.start()
+        drainer = OutboxDrainer({user_email: account})
+        drainer.start()
+        print(f"Worker {WORKER_ID} started.")
+
+        while True:
+            try:
+                claimed = poll_account(pipeline, account, incremental=incremental)
+                record_first_poll()
+                if not claimed:
+                    print(f"No new important unread emails. Sleeping for {poll_interval}s...")
+                    time.sleep(poll_interval)
                 
             except KeyboardInterrupt:
-                print("Interrupted by user. Exiting.")
+                print("Interrupted by user. Finishing in-flight emails...")
+                pipeline.stop()
+                drainer.stop()
                 break
             except Exception as e:
                 print("Error in main loop:", e)
                 time.sleep(10)
     finally:
-        client.close()
+        close_client()
         print("MongoDB connection closed.")
 
+def multi_account_loop():
+    # Serves every enabled mailbox in the accounts collection from this process, sharing
+    # one pipeline, one Mongo pool and one Gemini rate budget between them.
+    try:
+        ensure_indexes()
+        ensure_stats()
+        metrics.start_metrics_server(get_stats, _gauge_stats)
+        scheduler = AccountScheduler()
+        pipeline = MessagePipeline()
+        pipeline.start()
+        # Shares the scheduler's dict, so the drain workers follow accounts as they come and go.
+        drainer = OutboxDrainer(scheduler.accounts)
+        drainer.start()
+        print(f"Worker {WORKER_ID} started in multi-account mode.")
+        last_refresh = 0.0
+
+        while True:
+            try:
+                if time.time() - last_refresh >= ACCOUNT_REFRESH_SECONDS:
+                    scheduler.refresh()
+                    last_refresh = time.time()
+                    if not scheduler.accounts:
+                        print("No accounts configured. Add one with --add-account.")
+                account, wait = scheduler.next_due()
+                if account is None:
+                    time.sleep(min(wait, ACCOUNT_REFRESH_SECONDS))
+                    continue
+                claimed = 0
+                try:
+                    claimed = poll_account(pipeline, account, limit=ACCOUNT_CLAIM_LIMIT)
+                    record_first_poll()
+                except Exception as e:
+                    print(f"Error polling {account.user_email}: {e}")
+                scheduler.reschedule(account, claimed)
+
+            except KeyboardInterrupt:
+                print("Interrupted by user. Finishing in-flight emails...")
+                pipeline.stop()
+                drainer.stop()
+                break
+            except Exception as e:
+                print("Error in main loop:", e)
+                time.sleep(10)
+    finally:
+        close_client()
+        print("MongoDB connection closed.")
+
+BACKFILL_PAGE_SIZE = 100
+BACKFILL_CHUNK_SIZE = 20
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m{seconds % 60:02d}s"
+
+def backfill_job_id(user_email: str, query: str, dry_run: bool) -> str:
+    return f"{user_email}:{hashlib.sha1(query.encode()).hexdigest()[:12]}" + (":dry-run" if dry_run else "")
+
+def run_backfill(account: Account, query: str, job_id: str = None, concurrency: int = CLASSIFY_WORKERS,
+                 rate: float = 0, dry_run: bool = False) -> Dict[str, Any]:
+    # Pages through every message matching `query`, checkpointing the next page token in
+    # backfill_jobs after each page is queued, so an interrupted run resumes where it stopped.
+    # `rate` caps messages per minute (0 = unlimited); Gemini calls still obey GEMINI_RPM.
+    job_id = job_id or backfill_job_id(account.user_email, query, dry_run)
+    now = int(time.time())
+    backfill_jobs_collection.update_one(
+        {"_id": job_id},
+        {"$setOnInsert": {"account": account.user_email, "query": query, "dry_run": dry_run, "page_token": None,
+                          "listed": 0, "submitted": 0, "estimate": None, "status": "running", "started_at": now}},
+        upsert=True
+    )
+    job = backfill_jobs_collection.find_one({"_id": job_id})
+    if job["status"] == "done":
+        print(f"Backfill {job_id} already finished: {job['submitted']} messages.")
+        return job
+    print(f"Backfill {job_id}: query {query!r}, {'resuming' if job['page_token'] else 'starting'}"
+          f"{' (dry run)' if dry_run else ''}.")
+
+    ensure_indexes()
+    ensure_stats()
+    metrics.start_metrics_server(get_stats, _gauge_stats)
+    limiter = TokenBucket(rate / 60.0, max(1, concurrency)) if rate > 0 else None
+    pipeline = MessagePipeline(classify_workers=concurrency, dry_run=dry_run)
+    pipeline.start()
+    drainer = None
+    if not dry_run:
+        drainer = OutboxDrainer({account.user_email: account})
+        drainer.start()
+    service = get_gmail_service(account.creds)
+    started = time.time()
+    listed_at_start = job["listed"]
+
+    def submit(msgs: List[Dict[str, Any]]) -> int:
+        for i in range(0, len(msgs), BACKFILL_CHUNK_SIZE):
+            chunk = msgs[i:i + BACKFILL_CHUNK_SIZE]
+            if limiter is not None:
+                for _ in chunk:
+                    limiter.acquire()
+            pipeline.submit(account, chunk)
+        return len(msgs)
+
+    try:
+        page_token = job["page_token"]
+        while True:
+            kwargs = {'userId': 'me', 'q': query, 'maxResults': BACKFILL_PAGE_SIZE}
+            if page_token:
+                kwargs['pageToken'] = page_token
+            resp = service.users().messages().list(**kwargs).execute()
+            msgs = resp.get('messages', []) or []
+            page_token = resp.get('nextPageToken')
+
+            if dry_run:
+                submitted = submit(msgs)
+            else:
+                # Queued work is durable, so the checkpoint can move past this page before it is processed.
+                enqueue_messages(account.user_email, msgs)
+                submitted = 0
+                while True:
+                    claimed = claim_messages(account.user_email, BACKFILL_CHUNK_SIZE)
+                    if not claimed:
+                        break
+                    submitted += submit(claimed)
+
+            update = {"$set": {"page_token": page_token, "updated_at": int(time.time())},
+                      "$inc": {"listed": len(msgs), "submitted": submitted}}
+            if job["estimate"] is None and resp.get('resultSizeEstimate') is not None:
+                job["estimate"] = resp['resultSizeEstimate']
+                update["$set"]["estimate"] = job["estimate"]
+            if not page_token:
+                update["$set"]["status"] = "done"
+            job = backfill_jobs_collection.find_one_and_update({"_id": job_id}, update, return_document=ReturnDocument.AFTER)
+
+            elapsed = time.time() - started
+            per_second = (job["listed"] - listed_at_start) / elapsed if elapsed else 0
+            progress = f"{job['listed']} listed, {job['submitted']} submitted"
+            if job["estimate"]:
+                remaining = max(0, job["estimate"] - job["listed"])
+                eta = format_duration(remaining / per_second) if per_second else "unknown"
+                progress += f" of ~{job['estimate']} ({min(100, 100 * job['listed'] // job['estimate'])}%), ETA {eta}"
+            print(f"Backfill {job_id}: {progress}, {per_second:.1f} msg/s.")
+            if not page_token:
+                break
+        pipeline.join()
+        if drainer is not None:
+            # Let the drain workers send what is due; actions backing off after a failure are
+            # left for the running agent.
+            due = {"account": account.user_email, "$or": [
+                {"status": "in_progress"},
+                {"status": "pending", "next_attempt_at": {"$lte": int(time.time())}}
+            ]}
+            while outbox_collection.count_documents(due):
+                time.sleep(1)
+            waiting = outbox_collection.count_documents({"account": account.user_email, "status": "pending"})
+            if waiting:
+                print(f"{waiting} outbox actions are waiting to be retried by the running agent.")
+        print(f"Backfill {job_id} finished in {format_duration(time.time() - started)}.")
+        return job
+    finally:
+        pipeline.stop()
+        if drainer is not None:
+            drainer.stop()
+
+set_stat("startup_import_seconds", round(time.perf_counter() - _IMPORT_STARTED, 3))
+
 if __name__ == "__main__":
-    main_loop(poll_interval=20)
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="Gmail AI agent")
+    parser.add_argument("--evaluate-preclassifier", action="store_true",
+                        help="replay labelled email_logs through the local pre-classifier and exit")
+    parser.add_argument("--rebuild-reputation", action="store_true",
+                        help="rebuild sender_reputation from email_logs and exit")
+    parser.add_argument("--rebuild-stats", action="store_true",
+                        help="recompute the dashboard counters in email_stats and exit")
+    parser.add_argument("--add-account", action="store_true",
+                        help="authorize a mailbox for multi-account mode and exit")
+    parser.add_argument("--token-file",
+                        help="with --add-account, import this token.json instead of opening a browser")
+    parser.add_argument("--multi-account", action="store_true",
+                        help="serve every mailbox in the accounts collection")
+    parser.add_argument("--non-interactive", action="store_true",
+                        help="never prompt or open a browser; fail if token.json is missing or unusable")
+    parser.add_argument("--backfill", metavar="QUERY",
+                        help="process every message matching this Gmail query, resumably, and exit")
+    parser.add_argument("--account", help="with --backfill, a mailbox from the accounts collection instead of token.json")
+    parser.add_argument("--job-id", help="with --backfill, the checkpoint to create or resume (default: derived from account and query)")
+    parser.add_argument("--concurrency", type=int, default=CLASSIFY_WORKERS, help="with --backfill, classify workers")
+    parser.add_argument("--rate", type=float, default=0, help="with --backfill, maximum messages per minute (0 = unlimited)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="with --backfill, classify and log to dry_run_logs without replying or changing labels")
+    parser.add_argument("--dead-letters", action="store_true",
+                        help="list outbox actions that ran out of retries and exit")
+    parser.add_argument("--retry-dead-letters", action="store_true",
+                        help="put dead outbox actions back in the queue and exit")
+    parser.add_argument("--failed-messages", action="store_true",
+                        help="list messages that ran out of processing attempts and exit")
+    parser.add_argument("--retry-failed-messages", action="store_true",
+                        help="put failed messages back in the queue and exit")
+    args = parser.parse_args()
+    if args.backfill:
+        if args.account:
+            doc = accounts_collection.find_one({"_id": args.account})
+            if doc is None:
+                raise SystemExit(f"Unknown account {args.account}. Add it with --add-account.")
+            account = load_account(doc)
+        else:
+            _, creds, user_email = gmail_authenticate(interactive=not args.non_interactive)
+            account = Account(user_email, creds)
+        try:
+            run_backfill(account, args.backfill, job_id=args.job_id, concurrency=args.concurrency,
+                         rate=args.rate, dry_run=args.dry_run)
+        finally:
+            close_client()
+    elif args.dead_letters:
+        print(json.dumps(dead_letters(), indent=2))
+    elif args.retry_dead_letters:
+        print(f"Requeued {retry_dead_letters()} outbox actions.")
+    elif args.failed_messages:
+        print(json.dumps(failed_messages(), indent=2))
+    elif args.retry_failed_messages:
+        print(f"Requeued {retry_failed_messages()} messages.")
+    elif args.add_account:
+        print(f"Added account {add_account(args.token_file)}.")
+    elif args.multi_account:
+        multi_account_loop()
+    elif args.rebuild_stats:
+        print(json.dumps(email_stats.rebuild_stats(email_logs_collection, email_stats_collection), indent=2))
+    elif args.rebuild_reputation:
+        print(f"Rebuilt reputation for {rebuild_sender_reputation()} senders.")
+    elif args.evaluate_preclassifier:
+        print(json.dumps(evaluate_preclassifier(), indent=2))
+    else:
+        main_loop(poll_interval=20, interactive=not args.non_interactive)
\ No newline at end of file
@@ -0,0 +1,121 @@
+# metrics.py
+# Prometheus metrics and per-message log lines for the agent.
+# Nothing is recorded until start_metrics_server() has run (METRICS_PORT set), so with metrics
+# off observe() is a single None check. prometheus-client is only imported at that point.
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Set
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+PREFIX = "gmail_agent"
+# Seconds, from a single Mongo write up to a Gemini call that waited out its retries.
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_metrics: Dict[str, Any] = {"stage": None, "errors": None, "port": None}
+_stage_children: Dict[str, Any] = {}
+_queues: Dict[str, Any] = {}
+_lock = threading.Lock()
+
+
+def observe(stage: str, seconds: float):
+    histogram = _metrics["stage"]
+    if histogram is None:
+        return
+    child = _stage_children.get(stage)
+    if child is None:
+        child = _stage_children.setdefault(stage, histogram.labels(stage))
+    child.observe(seconds)
+
+@contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+def error_label(error: Exception) -> str:
+    # HTTP status for Google API errors, the exception class otherwise; both keep label cardinality low.
+    status = getattr(getattr(error, "resp", None), "status", None)
+    return str(status) if status else type(error).__name__
+
+def count_error(source: str, error: Exception):
+    counter = _metrics["errors"]
+    if counter is not None:
+        counter.labels(source, error_label(error)).inc()
+
+def register_queue(name: str, q):
+    # Depths are read at scrape time, so queue operations stay untouched.
+    _queues[name] = q
+
+
+class AgentCollector:
+    """Exposes the agent's in-process stats and pipeline queue depths at scrape time.
+
+    Stats written with set_stat() are gauges, everything bumped with bump_stat() is a counter.
+    """
+
+    def __init__(self, get_stats: Callable[[], Dict[str, Any]], gauge_names: Set[str]):
+        self.get_stats = get_stats
+        self.gauge_names = gauge_names
+
+    def collect(self):
+        from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+        for name, value in sorted(self.get_stats().items()):
+            if not isinstance(value, (int, float)):
+                continue
+            if name in self.gauge_names:
+                yield GaugeMetricFamily(f"{PREFIX}_{name}", f"Agent stat {name}", value=value)
+            else:
+                yield CounterMetricFamily(f"{PREFIX}_{name}", f"Agent stat {name}", value=value)
+        depth = GaugeMetricFamily(f"{PREFIX}_queue_depth", "Items waiting in a pipeline queue", labels=["queue"])
+        for name, q in sorted(_queues.items()):
+            depth.add_metric([name], q.qsize())
+        yield depth
+
+def start_metrics_server(get_stats: Callable[[], Dict[str, Any]], gauge_names: Set[str],
+                         port: int = METRICS_PORT) -> bool:
+    if not port:
+        return False
+    try:
+        from prometheus_client import Counter, Histogram, REGISTRY, start_http_server
+    except ImportError:
+        print("METRICS_PORT is set but prometheus-client is not installed. Metrics are disabled.")
+        return False
+    with _lock:
+        if _metrics["port"] is not None:
+            return True
+        try:
+            start_http_server(port)
+        except OSError as e:
+            print(f"Could not serve metrics on port {port}: {e}")
+            return False
+        _metrics["stage"] = Histogram(f"{PREFIX}_stage_seconds", "Time spent per pipeline stage or external call",
+                                      ["stage"], buckets=STAGE_BUCKETS)
+        _metrics["errors"] = Counter(f"{PREFIX}_errors", "Failed Gmail, Calendar, Gemini and MongoDB calls",
+                                     ["source", "error"])
+        REGISTRY.register(AgentCollector(get_stats, gauge_names))
+        _metrics["port"] = port
+    print(f"Serving Prometheus metrics on :{port}/metrics")
+    return True
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+def log_event(event: str, trace_id: str = None, **fields):
+    # One line per event. LOG_FORMAT=json emits JSON lines for log shippers; the default stays readable.
+    # Written in one call so lines from concurrent workers never interleave.
+    if LOG_FORMAT == "json":
+        line = json.dumps({"ts": round(time.time(), 3), "event": event, "trace_id": trace_id, **fields}, default=str)
+    else:
+        details = " ".join(f"{k}={v!r}" if isinstance(v, str) and " " in v else f"{k}={v}"
+                           for k, v in fields.items() if v is not None)
+        line = f"[{trace_id or '-'}] {event} {details}".rstrip()
+    sys.stdout.write(line + "\n")
@@ -0,0 +1,134 @@
+# test_app.py
+# Dashboard API: keyset pagination, the email_stats counters on delete and the live-update watchers.
+import threading
+import time
+import types
+from unittest import mock
+
+import pytest
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+
+import email_stats
+
+pytest.importorskip("flask_socketio")
+# app.py starts its MongoDB watcher thread on import; here the watchers are run by the tests
+# instead, so a background one cannot race them for the patched collections.
+with mock.patch.object(threading.Thread, "start"):
+    import app as dashboard
+
+
+@pytest.fixture
+def client(mongo, monkeypatch):
+    monkeypatch.setattr(dashboard, "logs", mongo["email_logs"])
+    monkeypatch.setattr(dashboard, "stats", mongo["email_stats"])
+    monkeypatch.setitem(dashboard._stats_cache, "at", 0.0)
+    return dashboard.app.test_client()
+
+def seed_logs(logs, processed_at: list) -> list:
+    docs = [{"_id": ObjectId(), "message_id": f"m{i}", "subject": f"Email {i}", "ai_category": "meeting",
+             "processed_at": at} for i, at in enumerate(processed_at)]
+    logs.insert_many(docs)
+    return docs
+
+
+def test_emails_pages_through_ties_without_gaps(client, mongo):
+    # Several emails share a processed_at second, so the cursor has to break ties on _id.
+    docs = seed_logs(mongo["email_logs"], [100, 100, 100, 200, 200, 300, 300])
+    expected = [str(d["_id"]) for d in sorted(docs, key=lambda d: (d["processed_at"], d["_id"]), reverse=True)]
+
+    seen, cursor = [], None
+    while True:
+        body = client.get("/api/emails?limit=3" + (f"&cursor={cursor}" if cursor else "")).get_json()
+        assert len(body["emails"]) <= 3
+        seen += [e["_id"] for e in body["emails"]]
+        cursor = body["next_cursor"]
+        if not cursor:
+            break
+    assert seen == expected
+
+def test_emails_rejects_a_bad_cursor(client):
+    assert client.get("/api/emails?cursor=not-a-cursor").status_code == 400
+
+def test_delete_before_counters_exist_keeps_the_fallback(client, mongo):
+    docs = seed_logs(mongo["email_logs"], [100, 200, 300])
+    assert client.get("/api/stats").get_json()["total"] == 3
+
+    assert client.delete(f"/api/delete/{docs[0]['_id']}").get_json()["success"]
+    assert mongo["email_stats"].count_documents({}) == 0
+    assert client.get("/api/stats").get_json()["total"] == 2
+
+def test_delete_decrements_seeded_counters(client, mongo):
+    docs = seed_logs(mongo["email_logs"], [100, 200, 300])
+    email_stats.rebuild_stats(mongo["email_logs"], mongo["email_stats"])
+
+    client.delete(f"/api/delete/{docs[0]['_id']}")
+    totals = client.get("/api/stats").get_json()
+    assert totals["total"] == 2 and totals["categories"]["meeting"] == 2
+
+
+class StopWatching(BaseException):
+    """Ends the watcher loops, which otherwise run forever and catch Exception."""
+
+@pytest.fixture
+def emitted(monkeypatch):
+    events = []
+    monkeypatch.setattr(dashboard.socketio, "emit", lambda event, data=None: events.append((event, data)))
+    monkeypatch.setitem(dashboard.watcher_state, "mode", None)
+    return events
+
+def test_watcher_falls_back_to_tailing_without_change_streams(client, emitted, monkeypatch):
+    def no_change_streams(*args, **kwargs):
+        raise OperationFailure("The $changeStream stage is only supported on replica sets", code=40573)
+    monkeypatch.setattr(dashboard.logs, "watch", no_change_streams)
+    tailed = []
+    monkeypatch.setattr(dashboard, "tail_email_logs", lambda: tailed.append(True))
+    dashboard.watch_mongo()
+    assert tailed == [True]
+
+def test_change_stream_pushes_inserts_updates_and_deletes(client, emitted, monkeypatch):
+    oid = ObjectId()
+    changes = [
+        {"operationType": "insert", "fullDocument": {"_id": oid, "subject": "Hi", "body": "long", "processed_at": 1}},
+        {"operationType": "update", "fullDocument": {"_id": oid, "subject": "Hi", "ai_category": "meeting", "processed_at": 1}},
+        {"operationType": "delete", "documentKey": {"_id": oid}},
+    ]
+    class Stream:
+        resume_token = {"_data": "token"}
+        def __enter__(self):
+            return self
+        def __exit__(self, *exc):
+            return False
+        def __iter__(self):
+            return iter(changes)
+    streams = [Stream()]
+    def watch(*args, **kwargs):
+        if not streams:
+            raise StopWatching()
+        return streams.pop()
+    monkeypatch.setattr(dashboard.logs, "watch", watch)
+
+    with pytest.raises(StopWatching):
+        dashboard.watch_change_stream()
+    assert dashboard.watcher_state["mode"] == "change_stream"
+    assert [event for event, _ in emitted] == ["new_email", "email_updated", "email_deleted"]
+    assert "body" not in emitted[0][1] and emitted[2][1] == {"_id": str(oid)}
+
+def test_tailing_emits_new_and_late_entries_once(client, mongo, emitted, monkeypatch):
+    logs = mongo["email_logs"]
+    seed_logs(logs, [100, 101])
+    late, new = ObjectId(), ObjectId()
+    sleeps = []
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 1:
+            # A fresh entry, and one from a worker whose commit landed out of order.
+            logs.insert_many([{"_id": new, "processed_at": 105}, {"_id": late, "processed_at": 99}])
+        elif len(sleeps) == 3:
+            raise StopWatching()
+    monkeypatch.setattr(dashboard, "time", types.SimpleNamespace(time=time.time, sleep=sleep))
+
+    with pytest.raises(StopWatching):
+        dashboard.tail_email_logs()
+    assert dashboard.watcher_state["mode"] == "tailing"
+    assert sorted(data["_id"] for _, data in emitted) == sorted([str(late), str(new)])
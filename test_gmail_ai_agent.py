@@ -0,0 +1,506 @@
+# test_gmail_ai_agent.py
+# Runs the agent's parsing, queueing and outbox code against the fakes from benchmark.py.
+import json
+import time
+from collections import Counter
+
+import httplib2
+import pytest
+from google.api_core import exceptions as google_exceptions
+from googleapiclient.errors import HttpError
+
+import benchmark
+import email_stats
+import gmail_ai_agent as agent
+
+
+def parsed(i: int) -> dict:
+    data = agent.parse_message(benchmark.synthetic_message(i))
+    data["account"] = "me@example.com"
+    return data
+
+def claimed_message(gmail, i: int = 0) -> dict:
+    msg_id = gmail.order[i]
+    agent.enqueue_messages(gmail.user_email, [{"id": msg_id, "threadId": gmail.messages_by_id[msg_id]["threadId"]}])
+    [claimed] = agent.claim_messages(gmail.user_email, 1)
+    return claimed
+
+def http_error(status: int) -> HttpError:
+    return HttpError(httplib2.Response({"status": status}), b"rejected")
+
+def failing_request(error: Exception) -> benchmark.FakeRequest:
+    def fail():
+        raise error
+    return benchmark.FakeRequest(fail)
+
+
+def test_extract_body_prefers_plain_text_and_drops_quotes():
+    interview, digest, reply, meeting = (agent.extract_body(benchmark.synthetic_message(i)["payload"]) for i in range(4))
+    assert "technical interview" in interview and "<br>" not in interview
+    assert "Story 9" in digest and "track()" not in digest
+    assert "reference 2" in reply and "signed copy" not in reply
+    assert "room 4" in meeting and "Planner" not in meeting
+
+def test_extract_body_uses_the_part_charset():
+    assert "José" in agent.extract_body(benchmark.synthetic_message(2)["payload"])
+
+def test_fetch_bodies_keeps_the_charset_through_the_field_mask(gmail):
+    # Single-part mail carries its Content-Type among the payload headers, which FULL_FIELDS must select.
+    [record] = agent.fetch_bodies(gmail, [{"id": gmail.order[2]}])
+    assert "fetch_error" not in record
+    assert "José" in record["body"]
+
+@pytest.mark.parametrize("failing_format", ["metadata", "full"])
+def test_unfetched_messages_go_back_to_the_queue(mongo, gmail, account, monkeypatch, failing_format):
+    get = gmail.get
+    def get_or_fail(userId, id, format="full", **kwargs):
+        if format == failing_format:
+            return failing_request(http_error(500))
+        return get(userId, id, format=format, **kwargs)
+    monkeypatch.setattr(gmail, "get", get_or_fail)
+
+    claimed = claimed_message(gmail)
+    pipeline = agent.MessagePipeline(classify_workers=0, act_workers=0)
+    pipeline.submit(account, [claimed])
+
+    assert pipeline.classify_queue.empty() and pipeline.act_queue.empty()
+    doc = mongo["processed_messages"].find_one({"_id": claimed["id"]})
+    assert doc["status"] == "pending" and doc["attempts"] == 1
+    assert not pipeline.in_flight
+
+def test_claims_are_exclusive_and_released_for_retry(mongo, gmail):
+    agent.enqueue_messages(gmail.user_email, [{"id": i} for i in gmail.order[:2]])
+    first = agent.claim_messages(gmail.user_email, 1)
+    second = agent.claim_messages(gmail.user_email, 5)
+    assert len(first) == len(second) == 1 and first != second
+    assert agent.claim_messages(gmail.user_email, 5) == []
+
+    msg_id = first[0]["id"]
+    assert agent.release_claim(msg_id, max_attempts=3)
+    doc = mongo["processed_messages"].find_one({"_id": msg_id})
+    assert doc["status"] == "pending" and doc["next_attempt_at"] >= time.time() + agent.MESSAGE_RETRY_BASE - 1
+
+    # Backed off: not claimable until next_attempt_at has passed.
+    assert agent.claim_messages(gmail.user_email, 5) == []
+    mongo["processed_messages"].update_one({"_id": msg_id}, {"$set": {"next_attempt_at": int(time.time()) - 1}})
+    assert agent.claim_messages(gmail.user_email, 5) == first
+
+    # Out of attempts: parked as failed instead of queued again.
+    mongo["processed_messages"].update_one({"_id": msg_id}, {"$set": {"attempts": 3}})
+    assert not agent.release_claim(msg_id, max_attempts=3)
+    assert mongo["processed_messages"].find_one({"_id": msg_id})["status"] == "failed"
+    assert agent.processed_ids([msg_id]) == {msg_id}
+
+def test_backoff_grows_with_attempts(mongo, gmail):
+    claimed = claimed_message(gmail)
+    mongo["processed_messages"].update_one({"_id": claimed["id"]}, {"$set": {"attempts": 3}})
+    agent.release_claim(claimed["id"], max_attempts=5)
+    delay = mongo["processed_messages"].find_one({"_id": claimed["id"]})["next_attempt_at"] - time.time()
+    assert 4 * agent.MESSAGE_RETRY_BASE - 2 <= delay <= 4 * agent.MESSAGE_RETRY_BASE
+
+def test_failed_messages_can_be_requeued(mongo, gmail):
+    claimed = claimed_message(gmail)
+    assert not agent.release_claim(claimed["id"], max_attempts=1)
+    assert [doc["_id"] for doc in agent.failed_messages()] == [claimed["id"]]
+
+    assert agent.retry_failed_messages() == 1
+    assert agent.failed_messages() == [] and agent.processed_ids([claimed["id"]]) == set()
+    assert agent.claim_messages(gmail.user_email, 5) == [claimed]
+
+def test_expired_leases_are_reclaimed(mongo, gmail):
+    claimed = claimed_message(gmail)
+    mongo["processed_messages"].update_one({"_id": claimed["id"]},
+                                           {"$set": {"owner": "crashed:1", "lease_expires_at": int(time.time()) - 1}})
+    assert not agent.renew_lease(claimed["id"])
+    assert agent.claim_messages(gmail.user_email, 1) == [claimed]
+    assert agent.renew_lease(claimed["id"])
+
+def test_scheduler_keeps_one_live_entry_per_account(account):
+    scheduler = agent.AccountScheduler(min_interval=10, max_interval=40)
+    scheduler.accounts[account.user_email] = account
+    scheduler.intervals[account.user_email] = 10
+    scheduler._push(account.user_email, time.time())
+
+    # A quiet poll doubles the interval; the earlier, already due entry is stale.
+    scheduler.reschedule(account, claimed=0)
+    assert scheduler.intervals[account.user_email] == 20
+    found, wait = scheduler.next_due()
+    assert found is None and 0 < wait <= 20
+
+    # A full claim is due again at once, and only once.
+    scheduler.reschedule(account, claimed=5, limit=5)
+    assert scheduler.next_due() == (account, 0)
+    assert scheduler.next_due()[0] is None
+
+    scheduler.reschedule(account, claimed=0)
+    scheduler.reschedule(account, claimed=0)
+    assert scheduler.intervals[account.user_email] == 40
+
+def test_bad_label_ids_are_isolated_in_a_batch(mongo, gmail, account, monkeypatch):
+    batch_modify = gmail.batchModify
+    def reject_unknown(userId, body):
+        if any(msg_id not in gmail.messages_by_id for msg_id in body["ids"]):
+            return failing_request(http_error(400))
+        return batch_modify(userId, body)
+    monkeypatch.setattr(gmail, "batchModify", reject_unknown)
+
+    actions = []
+    for msg_id in [gmail.order[0], "missing", gmail.order[1]]:
+        action = agent.outbox_action(account, {"id": msg_id}, "labels", {"remove_labels": ["UNREAD"]})
+        action.update(status="in_progress", owner=agent.WORKER_ID, attempts=1)
+        actions.append(action)
+    mongo["outbox"].insert_many(actions)
+
+    agent.execute_actions(account, actions)
+
+    status = {doc["message_id"]: doc["status"] for doc in mongo["outbox"].find()}
+    assert status == {gmail.order[0]: "done", "missing": "dead", gmail.order[1]: "done"}
+    assert "UNREAD" not in gmail.messages_by_id[gmail.order[0]]["labelIds"]
+
+    with pytest.raises(HttpError):
+        agent.execute_actions(account, [actions[1]])
+
+def test_failed_actions_back_off_then_become_dead_letters(mongo, account):
+    action = agent.outbox_action(account, {"id": "m1"}, "reply", {})
+    action.update(status="in_progress", owner=agent.WORKER_ID, attempts=1)
+    mongo["outbox"].insert_one(action)
+
+    agent.fail_action(action, http_error(503))
+    doc = mongo["outbox"].find_one({"_id": action["_id"]})
+    assert doc["status"] == "pending" and doc["next_attempt_at"] >= action["next_attempt_at"]
+
+    mongo["outbox"].update_one({"_id": action["_id"]}, {"$set": {"status": "in_progress", "owner": agent.WORKER_ID}})
+    action["attempts"] = agent.OUTBOX_MAX_ATTEMPTS
+    agent.fail_action(action, http_error(503))
+    assert mongo["outbox"].find_one({"_id": action["_id"]})["status"] == "dead"
+
+def test_dry_run_classification_writes_no_reputation_or_cache(mongo, monkeypatch):
+    monkeypatch.setitem(agent._clients, "gemini", benchmark.FakeGemini())
+    monkeypatch.setattr(agent, "gemini_limiter", agent.TokenBucket(1000, 10))
+    batch = [parsed(1), parsed(2)]
+
+    agent.classify_messages(batch, dry_run=True)
+    assert mongo["sender_reputation"].count_documents({}) == 0
+    assert mongo["classification_cache"].count_documents({}) == 0
+
+    agent.classify_messages(batch)
+    assert mongo["sender_reputation"].count_documents({}) == 2
+
+def triage_record(sender: str = "talent@acme.example", **headers) -> dict:
+    return {"from_email": sender, "subject": "Interview invitation", "snippet": "Please pick a slot",
+            "triage_headers": headers}
+
+@pytest.mark.parametrize("data", [
+    triage_record("no-reply@hire.lever.co"),
+    triage_record(list_unsubscribe="<mailto:unsubscribe@acme.example>"),
+    triage_record("notifications@greenhouse.io", list_unsubscribe="<mailto:u@greenhouse.io>"),
+    triage_record(precedence="bulk"),
+])
+def test_preclassify_never_archives_on_a_single_signal(data):
+    assert agent.preclassify(data) is None
+
+def test_preclassify_archives_a_strong_signal_with_a_second_one():
+    result = agent.preclassify(triage_record(precedence="bulk", list_unsubscribe="<mailto:u@news.example>"))
+    assert result["action"] == "archive" and result["confidence"] >= agent.PRECLASSIFY_THRESHOLD
+    assert agent.preclassify(triage_record(precedence="list", auto_submitted="auto-generated")) is not None
+
+def test_preclassify_uses_sender_reputation_as_a_strong_signal():
+    bulk = {"no-reply@news.example": Counter(not_important=9, other=1)}
+    mixed = {"no-reply@news.example": Counter(not_important=6, interview=4)}
+    assert agent.preclassify(triage_record("no-reply@news.example"), reputation=bulk) is not None
+    assert agent.preclassify(triage_record("no-reply@news.example"), reputation=mixed) is None
+    assert agent.preclassify(triage_record("someone@news.example"), reputation=bulk) is None
+
+def test_preclassify_model_only_backs_up_a_strong_signal():
+    docs = [{"subject": "Weekly digest", "snippet": "ten stories"}] * 60
+    model = agent.NaiveBayesClassifier().fit(docs, ["not_important"] * 60)
+    assert agent.preclassify(triage_record(), model=model) is None
+    assert agent.preclassify(triage_record("no-reply@hire.lever.co"), model=model) is None
+    assert agent.preclassify(triage_record(precedence="bulk"), model=model) is not None
+
+def invoice(number: int, amount: int, date: str, sender: str = "billing@vendor.example", link: str = "a1") -> dict:
+    return {"id": f"inv-{number}", "from": f"Vendor Billing <{sender}>", "from_email": sender,
+            "subject": f"Invoice {number}",
+            "body": f"Invoice {number} for ${amount} is due on {date}. Pay at https://vendor.example/p/{link}"}
+
+INVOICE_RESULT = {"category": "important_email", "confidence": 0.9, "action": "no_action",
+                  "summary": "Invoice 1001 for $500 due 2025-09-01",
+                  "reply_template": {"should_reply": True, "subject": "Re: Invoice 1001", "body": "Paid $500."}}
+
+def test_exact_cache_hits_ignore_tracking_links_only(mongo):
+    agent.store_cached_classification(invoice(1001, 500, "2025-09-01"), INVOICE_RESULT)
+
+    hit = agent.lookup_cached_classification(invoice(1001, 500, "2025-09-01", link="b2"))
+    assert hit["summary"] == INVOICE_RESULT["summary"]
+    assert agent.get_stats()["cache_hits_exact"] >= 1
+
+    # Different numbers are a different email, so the old summary and reply are not reused.
+    assert agent.lookup_cached_classification(invoice(2734, 20, "2026-01-15")) is None
+    assert agent.classification_key(invoice(1001, 500, "2025-09-01")) != agent.classification_key(invoice(2734, 20, "2026-01-15"))
+
+def test_near_duplicates_stay_with_their_sender_and_carry_no_reply(mongo):
+    newsletter = {"category": "not_important", "confidence": 0.95, "action": "archive", "summary": "Weekly digest",
+                  "reply_template": {"should_reply": False, "subject": None, "body": None}}
+    first = invoice(1, 5, "2025-09-01", sender="digest@news.example")
+    agent.store_cached_classification(first, newsletter)
+
+    similar = dict(first, body=first["body"] + " See you next week.")
+    near = agent.lookup_cached_classification(similar)
+    assert near["category"] == "not_important" and near["summary"].startswith("Near-duplicate")
+    assert agent.lookup_cached_classification(dict(similar, from_email="digest@other.example")) is None
+
+    # Results that came with a reply are not reused for near-duplicates at all.
+    agent.store_cached_classification(invoice(1001, 500, "2025-09-01"), INVOICE_RESULT)
+    assert agent.lookup_cached_classification(dict(invoice(1001, 500, "2025-09-01"), subject="Invoice 1001 reminder")) is None
+
+def test_stats_seeding_never_overwrites_existing_counters(mongo):
+    mongo["email_logs"].insert_many([{"ai_category": "meeting", "processed_at": 1_750_000_000 + i} for i in range(3)])
+    agent.ensure_stats()
+    assert email_stats.read_totals(mongo["email_stats"])["total"] == 3
+    assert sum(doc["total"] for doc in mongo["email_stats"].find({"kind": "day"})) == 3
+
+    # A second agent starting at the same time, after the first one has already counted an email.
+    mongo["email_stats"].bulk_write(email_stats.stats_updates("meeting", 1_750_000_100))
+    email_stats.seed_stats(mongo["email_logs"], mongo["email_stats"])
+    agent.ensure_stats()
+    totals = email_stats.read_totals(mongo["email_stats"])
+    assert totals["total"] == 4 and totals["categories"]["meeting"] == 4
+
+def test_first_sync_lists_every_page_and_returns_the_history_id(mongo):
+    gmail = benchmark.FakeGmail(150)
+    msgs, history_id = agent.sync_new_messages(gmail, gmail.user_email)
+    assert len(msgs) == 150 and history_id == "1000"
+
+def test_incremental_sync_follows_history_pages_and_inbox_labels(mongo, gmail):
+    agent.save_history_id(gmail.user_email, "1000")
+    gmail.history_page_size = 1
+    added = gmail.deliver(20)
+    gmail.deliver(21, label_ids=["UNREAD", "INBOX"])
+    later = gmail.deliver(22, label_ids=["UNREAD", "INBOX"])
+    gmail.add_labels(later["id"], ["IMPORTANT"])
+
+    msgs, history_id = agent.sync_new_messages(gmail, gmail.user_email)
+    assert [m["id"] for m in msgs] == [added["id"], later["id"]]
+    assert history_id == str(gmail.history_id)
+
+def test_expired_history_id_falls_back_to_a_full_sync(mongo, gmail):
+    agent.save_history_id(gmail.user_email, "1000")
+    gmail.deliver(20)
+    gmail.expire_history()
+    msgs, history_id = agent.sync_new_messages(gmail, gmail.user_email)
+    assert len(msgs) == len(gmail.order) == 9 and history_id == str(gmail.history_id)
+
+def test_poll_saves_the_history_id_once_messages_are_queued(mongo, gmail, account):
+    pipeline = agent.MessagePipeline(classify_workers=0, act_workers=0)
+    agent.poll_account(pipeline, account, limit=0)
+    assert agent.get_history_id(account.user_email) == "1000"
+    assert mongo["processed_messages"].count_documents({"status": "pending"}) == 8
+
+    gmail.deliver(20)
+    agent.poll_account(pipeline, account, limit=0)
+    assert agent.get_history_id(account.user_email) == "1001"
+    assert mongo["processed_messages"].count_documents({"status": "pending"}) == 9
+
+def test_poll_keeps_the_old_history_id_when_queueing_fails(mongo, gmail, account, monkeypatch):
+    agent.save_history_id(account.user_email, "1000")
+    gmail.deliver(20)
+    def fail(mailbox, msgs):
+        raise RuntimeError("mongo down")
+    monkeypatch.setattr(agent, "enqueue_messages", fail)
+    with pytest.raises(RuntimeError):
+        agent.poll_account(agent.MessagePipeline(classify_workers=0, act_workers=0), account)
+    assert agent.get_history_id(account.user_email) == "1000"
+
+@pytest.fixture
+def calendar(monkeypatch):
+    service = benchmark.FakeCalendar()
+    monkeypatch.setattr(agent, "build_calendar_service", lambda creds: service)
+    monkeypatch.setattr(agent._thread_local, "calendar_services", {}, raising=False)
+    return service
+
+INTERVIEW = {"summary": "Backend interview", "start": "2025-09-18T10:00:00+05:30", "end": "2025-09-18T11:00:00+05:30"}
+
+def test_calendar_follow_ups_patch_the_same_event(mongo, calendar, account):
+    first = agent.create_calendar_events(account, [("a", INTERVIEW, "talent@acme.example")])["a"]
+    # The same interview restated in UTC and other capitalization: same fingerprint, same event.
+    follow_up = dict(INTERVIEW, summary="BACKEND Interview", start="2025-09-18T04:30:00Z", end="2025-09-18T05:30:00Z")
+    second = agent.create_calendar_events(account, [("b", follow_up, "talent@acme.example")])["b"]
+    assert second["id"] == first["id"] and len(calendar.events_by_id) == 1
+    assert mongo["calendar_events"].count_documents({}) == 1
+
+def test_calendar_insert_conflict_patches_the_existing_event(mongo, calendar, account):
+    agent.create_calendar_events(account, [("a", INTERVIEW, "talent@acme.example")])
+    mongo["calendar_events"].delete_many({})  # e.g. a retry whose first attempt died before recording it
+
+    event = agent.create_calendar_events(account, [("a", INTERVIEW, "talent@acme.example")])["a"]
+    assert isinstance(event, dict) and len(calendar.events_by_id) == 1
+    assert mongo["calendar_events"].find_one()["event_id"] == event["id"]
+
+@pytest.mark.parametrize("recorded", [True, False])
+def test_calendar_restores_a_prep_event_the_user_deleted(mongo, calendar, account, recorded):
+    event = agent.create_calendar_events(account, [("a", INTERVIEW, "talent@acme.example")])["a"]
+    calendar.delete("primary", event["id"]).execute()
+    if not recorded:
+        mongo["calendar_events"].delete_many({})
+
+    event = agent.create_calendar_events(account, [("b", INTERVIEW, "talent@acme.example")])["b"]
+    assert event["status"] == "confirmed" and len(calendar.visible()) == 1
+
+def test_memory_stats_describe_the_latest_cycle(mongo, gmail, account):
+    pipeline = agent.MessagePipeline(classify_workers=0, act_workers=0)
+    agent.enqueue_messages(gmail.user_email, [{"id": i} for i in gmail.order])
+    pipeline.submit(account, agent.claim_messages(gmail.user_email, 4))
+    big = agent.get_stats()["cycle_body_bytes"]
+    pipeline.submit(account, agent.claim_messages(gmail.user_email, 1))
+    small = agent.get_stats()
+    assert 0 < small["cycle_body_bytes"] < big
+    if agent.current_rss_kb() is not None:
+        assert small["cycle_rss_kb"] > 0
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(agent.time, "monotonic", fake.monotonic)
+    monkeypatch.setattr(agent.time, "sleep", fake.sleep)
+    return fake
+
+class ScriptedGemini(benchmark.FakeGemini):
+    """Raises the queued exceptions or returns the queued texts, then answers like FakeGemini."""
+
+    def __init__(self, script: list):
+        super().__init__()
+        self.script = list(script)
+        self.calls = 0
+
+    def generate_content(self, contents):
+        self.calls += 1
+        if self.script:
+            step = self.script.pop(0)
+            if isinstance(step, Exception):
+                raise step
+            return benchmark.FakeResponse(step, contents[0]["parts"][0])
+        return super().generate_content(contents)
+
+@pytest.fixture
+def gemini(monkeypatch, clock):
+    def install(script=()):
+        model = ScriptedGemini(script)
+        monkeypatch.setitem(agent._clients, "gemini", model)
+        monkeypatch.setattr(agent, "gemini_limiter", agent.TokenBucket(1000, 10))
+        return model
+    return install
+
+def test_token_bucket_allows_a_burst_then_paces(clock):
+    bucket = agent.TokenBucket(rate=2, capacity=3)
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.sleeps == []
+    bucket.acquire()
+    bucket.acquire()
+    assert sum(clock.sleeps) == pytest.approx(1.0)
+
+def test_gemini_retries_retryable_errors_with_capped_backoff(gemini, clock):
+    model = gemini([google_exceptions.TooManyRequests("quota")] * 3)
+    result = agent.call_gemini_for_structured("Weekly digest", "news@example.com", "Stories")
+    assert result["category"] == "not_important" and model.calls == 4
+    assert len(clock.sleeps) == 3
+    assert all(delay <= min(agent.GEMINI_BACKOFF_MAX, agent.GEMINI_BACKOFF_BASE * 2 ** i)
+               for i, delay in enumerate(clock.sleeps))
+
+def test_gemini_gives_up_after_the_retry_limit(gemini):
+    model = gemini([google_exceptions.ServiceUnavailable("down")] * (agent.GEMINI_MAX_RETRIES + 1))
+    with pytest.raises(agent.GeminiUnavailableError):
+        agent.call_gemini_for_structured("Hello", "a@example.com", "Body")
+    assert model.calls == agent.GEMINI_MAX_RETRIES + 1
+
+def test_gemini_does_not_retry_other_errors(gemini):
+    model = gemini([ValueError("bad request")])
+    with pytest.raises(ValueError):
+        agent.call_gemini_for_structured("Hello", "a@example.com", "Body")
+    assert model.calls == 1
+
+def test_gemini_batch_answers_are_matched_by_id(gemini):
+    batch = [parsed(0), parsed(1), parsed(3)]
+    # Fenced JSON, one email missing and one id the request never had.
+    answer = [dict(benchmark.FakeGemini.classify(f"Email Subject: {batch[0]['subject']}"), id=batch[0]["id"]),
+              dict(benchmark.FakeGemini.classify("Email Subject: Weekly digest"), id=batch[1]["id"]),
+              dict(benchmark.FakeGemini.classify("Email Subject: other"), id="not-asked")]
+    model = gemini(["```json\n" + json.dumps(answer) + "\n```"])
+    results = agent.call_gemini_for_structured_batch(batch)
+    assert set(results) == {d["id"] for d in batch}
+    assert results[batch[0]["id"]]["category"] == "interview"
+    assert results[batch[1]["id"]]["category"] == "not_important"
+    assert results[batch[2]["id"]]["category"] == "meeting"  # asked again on its own
+    assert model.calls == 2
+
+def test_gemini_batch_falls_back_to_single_calls_on_garbage(gemini):
+    batch = [parsed(0), parsed(1)]
+    model = gemini(["I cannot help with that."])
+    results = agent.call_gemini_for_structured_batch(batch)
+    assert [results[d["id"]]["category"] for d in batch] == ["interview", "not_important"]
+    assert model.calls == 3
+
+@pytest.fixture
+def backfill_env(mongo, gmail, calendar, monkeypatch):
+    monkeypatch.setitem(agent._clients, "gemini", benchmark.FakeGemini())
+    monkeypatch.setattr(agent, "gemini_limiter", agent.TokenBucket(1000, 10))
+    monkeypatch.setattr(agent, "BACKFILL_PAGE_SIZE", 3)
+    pages = []
+    list_messages = gmail.list
+    def list_and_record(userId, pageToken=None, **kwargs):
+        pages.append(pageToken)
+        return list_messages(userId, pageToken=pageToken, **kwargs)
+    monkeypatch.setattr(gmail, "list", list_and_record)
+    return pages
+
+def test_backfill_resumes_from_its_checkpoint(backfill_env, mongo, gmail, account, monkeypatch):
+    pages = backfill_env
+    list_messages = gmail.list
+    def fail_on_second_page(userId, pageToken=None, **kwargs):
+        if pageToken == "3":
+            return failing_request(http_error(503))
+        return list_messages(userId, pageToken=pageToken, **kwargs)
+    monkeypatch.setattr(gmail, "list", fail_on_second_page)
+    with pytest.raises(HttpError):
+        agent.run_backfill(account, "in:inbox", concurrency=1, dry_run=True)
+    job = mongo["backfill_jobs"].find_one()
+    assert job["page_token"] == "3" and job["listed"] == 3 and job["status"] == "running"
+
+    monkeypatch.setattr(gmail, "list", list_messages)
+    pages.clear()
+    job = agent.run_backfill(account, "in:inbox", concurrency=1, dry_run=True)
+    assert pages == ["3", "6"]
+    assert job["status"] == "done" and job["listed"] == 8 and job["estimate"] == 8
+    assert mongo["dry_run_logs"].count_documents({}) == 8
+
+    # A finished job is not listed again.
+    pages.clear()
+    assert agent.run_backfill(account, "in:inbox", concurrency=1, dry_run=True)["status"] == "done"
+    assert pages == []
+
+def test_backfill_dry_run_changes_nothing(backfill_env, mongo, gmail, account):
+    agent.run_backfill(account, "in:inbox", concurrency=2, dry_run=True)
+    assert mongo["dry_run_logs"].count_documents({}) == 8
+    for name in ("email_logs", "outbox", "processed_messages", "sender_reputation", "classification_cache"):
+        assert mongo[name].count_documents({}) == 0, name
+    assert gmail.sent == [] and all("UNREAD" in m["labelIds"] for m in gmail.messages_by_id.values())
+
+def test_backfill_processes_through_the_queue_and_outbox(backfill_env, mongo, gmail, account):
+    job = agent.run_backfill(account, "in:inbox", concurrency=2)
+    assert job["status"] == "done" and job["submitted"] == 8
+    assert mongo["processed_messages"].count_documents({"status": "done"}) == 8
+    assert mongo["email_logs"].count_documents({}) == 8
+    assert mongo["outbox"].count_documents({"status": {"$ne": "done"}}) == 0
+    assert all("UNREAD" not in m["labelIds"] for m in gmail.messages_by_id.values())